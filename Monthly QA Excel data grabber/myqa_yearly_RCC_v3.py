@@ -6,461 +6,203 @@ Changes in v3:
 Updated row numbers for new v3 template
 Added a column for each sheet to show the site
 Added extra tabs for the new kV tests 10, 11 and 12
-
-Cell Key for Excel sheets:
-df[x].iloc[x,y]
-x = row-1
-y = column where A = 0, B = 1 etc.
+18.10.26 Only the rows and columns used are read from each workbook, streamed from the sheet xml by qa_workbook.py
+18.10.26 Workbooks read in parallel processes
+18.10.26 Cells read from each workbook cached in extraction_cache, only new or changed workbooks are read again
+18.10.26 sheet1() to sheet12() replaced by the template layout in qa_layouts.py, all the cells needed are read in one pass
+18.10.26 output.xlsx written in one pass by a write-only workbook, optional long format csv or parquet file
+18.10.26 Measurements saved in the results_db SQLite store across years, see qa_results_store.py
+18.10.26 Row numbers of the tests found in each workbook from the test headings and Tolerance/Action level rows,
+         workbooks of different template versions can be in the same directory
+18.10.26 Workbooks that cannot be read are reported and left out instead of stopping the run
+
+The cells read for each test are set out in qa_layouts.py relative to the test's row number, which is found in
+each workbook, tests not in a workbook's template are left out of its results
 
 Usage:
 Copy the monthly QA excel sheets to a single directory
 Enter that directory in the site specific variables below with two backslashes instead of one
-Ensure that the row numbers below are same as the tolerance row for each test in the excel sheets
 Run this python script to create the output.xlsx summary excel file
+Set long_format_file to also save every measurement as one row of machine, test, date, group, parameter and value,
+as a .csv file or a .parquet file (needs pyarrow), for loading the yearly data without excel
+Set results_db to add the measurements of new or changed workbooks to an SQLite results store kept across years,
+query it with qa_results_store.py
+The cells read are cached in the extraction_cache folder in the same directory, it is updated automatically when
+a workbook changes and can be deleted at any time, the row numbers found for each template are kept in layouts.json
 
 '''
 
 import pandas as pd
 import os
+import qa_workbook
+import qa_layouts
+import qa_results_store
 import sys
 import ctypes
-import datetime
+import json
+import functools
+import multiprocessing
+import zipfile
+import xml.etree.ElementTree as ElementTree
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
 
 #Site specific variables
 path = r'C:\\Scripts\\Proton annual QA\\for_review\\'  # Change this to be the directory where the monthly QA excel sheets are coppied to
-row1 = 13 # row numbers of the tolerances for Test 1, 2..., (row number of the word Tolerance/s)
-row2 = 39
-row3 = 58
-row4 = 74
-row5 = 95
-row6 = 127
-row7 = 153
-row8 = 182
-row9 = 208
-row10 = 222 # row numbers of the Action levels for Test 10, 11 & 12
-row11 = 248
-row12 = 258
+template_version = 'v3'  # template layout in qa_layouts.py, used for all template versions with the same tests
+processes = None  # number of processes reading the workbooks, None for one per cpu, 1 to read them one at a time
+cache_dir = os.path.join(path, 'extraction_cache')  # cells read from each workbook, None to always read the workbooks
+long_format_file = None  # e.g. 'output_long.csv' or 'output_long.parquet' to save every measurement in long format
+results_db = None  # e.g. r'C:\\Scripts\\Proton annual QA\\qa_results.db' to keep every measurement in a results store
 
 
-data_files = [f for f in sorted(os.listdir(path), key=lambda x: os.path.getmtime(os.path.join(path, x))) if (f.lower().endswith('.xlsx'))]
-file_list = []
-df = {}
+layout = qa_layouts.LAYOUTS[template_version]
+data_files = []
+workbooks = []
 dateMissingCounter = 0
 
 
-def initiate_df():
-    i = 0
-    for x in data_files:
-        df["{0}".format(i)] = pd.read_excel(path + x, header=None, sheet_name='Monthly QA Sheet')
-        temp = df["{0}".format(i)].iloc[1,1].split('-')
-        i +=1
-
-
-def sheet1():
-    global dateMissingCounter
-    # Absolute Dosimetry: Difference from baseline. Order of energy: 200, 180, 120, 100, 80
-    sheet1_data = {}
-    first = True
-    for x in df:
-        if first:
-            temp_data = ["Machine","Chamber SN"]
-            y = 3
-            while y < 8:
-                temp_data.append(str(df[x].iloc[row1+7, y]) + " MeV Dose Dif. (%)")
-                y += 1
-            sheet1_data["Date"] = temp_data
-            first = False
-        temp_data=[]
-        temp_data.append(df[x].iloc[4, 2])
-        temp_data.append(df[x].iloc[row1+1, 3])
-        y=3
-        while y < 8:
-            temp_data.append(df[x].iloc[row1+16, y])
-            y+=1
-        try:
-            sheet1_data[(df[x].iloc[row1+19, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet1_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet1_df = pd.DataFrame(data=sheet1_data)
-    return sheet1_df
-
-
-def sheet2():
-    global dateMissingCounter
-    # Dose Linearity: Energy, MU / spot and difference from 1MU/spot
-    sheet2_data = {}
-    first = True
-    for x in df:
-        if first:
-            temp_data = ["Machine","Energy (MeV)"]
-            y = row2+4
-            while y < row2+10:
-                temp_data.append(str(df[x].iloc[y, 1]) + " MU/spot Dose Dif. (%)")
-                y += 1
-            sheet2_data["Date"] = temp_data
-            first = False
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        temp_data.append(df[x].iloc[row2, 2])
-        y = row2+4
-        while y < row2+10:
-            temp_data.append(df[x].iloc[y, 4])
-            y += 1
-        try:
-            sheet2_data[(df[x].iloc[row2+11, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet2_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet2_df = pd.DataFrame(data=sheet2_data)
-    return sheet2_df
-
-
-def sheet3():
-    global dateMissingCounter
-    # Output dependence on Gantry Angle: Max deviation and angle
-    sheet3_data = {}
-    first = True
-    for x in df:
-        if first:
-            temp_data = ["Machine", "Energy (MeV)", "Max Deviation (%)"]
-            sheet3_data["Date"] = temp_data
-            first = False
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        temp_data.append(df[x].iloc[row3-3, 2])
-        temp_data.append(df[x].iloc[row3+8, 2])
-        try:
-            sheet3_data[(df[x].iloc[row3+9, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet3_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet3_df = pd.DataFrame(data=sheet3_data)
-    return sheet3_df
-
-
-def sheet4():
-    global dateMissingCounter
-    # Zebra single energy layers
-    # Baseline then measured then difference
-    sheet4_data = {}
-    first = True
-    for x in df:
-        if first:
-            temp_data = ["10x10 layer energy (MeV):"]
-            y = row4+2
-            while y < row4+13:
-                temp_data.append(df[x].iloc[y, 1])
-                temp_data.append(df[x].iloc[y, 1])
-                y += 1
-            sheet4_data["0"] = temp_data
-            temp_data =["Machine"]
-            z = 0
-            while z < 22:
-                temp_data.append('Measured Range (cm)')
-                temp_data.append('Difference (cm)')
-                z +=2
-            sheet4_data["Date"] = temp_data
-            first = False
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        y = row4+2
-        while y < row4+13:
-            temp_data.append(df[x].iloc[y, 5])
-            temp_data.append((df[x].iloc[y, 5])-(df[x].iloc[y, 4]))
-            y += 1
-        try:
-            sheet4_data[(df[x].iloc[row4+15, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet4_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet4_df = pd.DataFrame(data=sheet4_data)
-    return sheet4_df
-
-
-def sheet5():
-    global dateMissingCounter
-    # Zebra Spread out Bragg Peaks
-    sheet5_data = {}
-    first = True
-    baselinedMachines = []
-    for x in df:
-        # Creating energy headers
-        if first:
-            temp_data =["Field ID:"]
-            y = 0
-            while y < 4:
-                temp_data.append(df[x].iloc[row5+7, 1])
-                y += 1
-            y = 0
-            while y < 4:
-                temp_data.append(df[x].iloc[row5+11, 1])
-                y += 1
-            y = 0
-            while y < 4:
-                temp_data.append(df[x].iloc[row5+15, 1])
-                y += 1
-            y = 0
-            while y < 4:
-                temp_data.append(df[x].iloc[row5+19, 1])
-                y += 1
-            sheet5_data["0"] = temp_data
-            y = 0
-            temp_data =["Machine"]
-            while y < 16:
-                temp_data.append('R90 (cm)')
-                temp_data.append('Modulation (cm)')
-                temp_data.append('Flatness (%)')
-                temp_data.append('Distal 80-20 (cm)')
-                y += 4
-            sheet5_data["Date"] = temp_data
-            first = False
-        currentMachine = df[x].iloc[4, 2]
-        if currentMachine not in baselinedMachines:
-            temp_data =[]
-            temp_data.append(currentMachine)
-            y = row5+6
-            while y < row5+22:
-                temp_data.append(df[x].iloc[y, 4])
-                y += 1
-            key = currentMachine + " Baseline:"
-            sheet5_data[key] = temp_data
-            baselinedMachines.append(currentMachine)
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        y = row5+6
-        while y < row5+22:
-            temp_data.append(df[x].iloc[y, 5])
-            y += 1
-        try:
-            sheet5_data[(df[x].iloc[row5+24, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet5_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet5_df = pd.DataFrame(data=sheet5_data)
-    return sheet5_df
-
-
-def sheet6():
-    global dateMissingCounter
-    # Lynx: Spot size, shape and relative spot position accuracy
-    sheet6_data = {}
-    temp_data = ["Machine", "Energy (MeV)", "SigmaX (mm)", "SigmaX diff (%)", "SigmaY (mm)",  "SigmaY diff (%)", "SkewX", "SkewY", "No. points >1mm", "max. dev. (mm)"]
-    sheet6_data["Date"] = temp_data
-    for x in df:
-        for y in range(0, 12, 2):
-            temp_data = []
-            currentRow = row6 + y + 6
-            temp_data.append(df[x].iloc[4, 2])
-            energy = df[x].iloc[currentRow, 1]
-            temp_data.append(energy)
-            temp_data.append(df[x].iloc[currentRow, 2])
-            temp_data.append(df[x].iloc[currentRow+1, 2])
-            temp_data.append(df[x].iloc[currentRow, 3])
-            temp_data.append(df[x].iloc[currentRow+1, 2])
-            temp_data.append(df[x].iloc[currentRow, 4])
-            temp_data.append(df[x].iloc[currentRow, 5])
-            temp_data.append(df[x].iloc[currentRow, 6])
-            temp_data.append(df[x].iloc[currentRow, 7])
-            try:
-                sheet6_data[((df[x].iloc[row6+20, 7]).strftime("%d/%m/%Y")) + '_' + str(energy)] = temp_data
-            except:
-                if y == 0:
-                    dateMissingCounter += 1
-                sheet6_data['blank' + str(dateMissingCounter) + '_' + str(energy)] = temp_data
-    sheet6_df = pd.DataFrame(data=sheet6_data)
-    return sheet6_df
-
-
-def sheet7():
-    global dateMissingCounter
-    # Lateral Uniformity
-    sheet7_data = {}
-    first = True
-    for x in df:
-        # Energy Labels
-        if first:
-            temp_data = ["20x20 Layer Energy (MeV)"]
-            y = 0
-            while y < 5:
-                temp_data.append(df[x].iloc[row7+7, 1])
-                y += 1
-            y = 0
-            while y < 5:
-                temp_data.append(df[x].iloc[row7+12, 1])
-                y += 1
-            y = 0
-            while y < 5:
-                temp_data.append(df[x].iloc[row7+17, 1])
-                y += 1
-            sheet7_data["0"] = temp_data
-
-            temp_data = ["Machine"]
-            y = row7+6
-            while y < row7+21:
-                temp_data.append(df[x].iloc[y, 3])
-                y+=1
-            sheet7_data["Date"] = temp_data
-
-            temp_data = ["all"]
-            y = row7+6
-            while y < row7+21:
-                temp_data.append(df[x].iloc[y, 4])
-                y += 1
-            sheet7_data["Baseline"] = temp_data
-            first = False
-        # Measured data
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        y = row7+6
-        while y < row7+21:
-            temp_data.append(df[x].iloc[y, 5])
-            y += 1
-        try:
-            sheet7_data[(df[x].iloc[row7+23, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet7_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet7_df = pd.DataFrame(data=sheet7_data)
-    return sheet7_df
-
-
-def sheet8():
-    global dateMissingCounter
-    # Proton beam to X-ray isocentre alignment
-    sheet8_data = {}
-    temp_data = ["Machine", "Energies (MeV)", "Requested Gantry Angle (°)", "Max gantry angle error (°)", "Max gantry tilt (°)", "Max beam distance to iso (mm)"]
-    sheet8_data["Date"] = temp_data
-    for x in df:
-        for z in range(1, 16, 4):
-            y = row8+3
-            temp_data = []
-            temp_data.append(df[x].iloc[4, 2])
-            temp_data.append(df[x].iloc[y, 3])
-            y += z
-            while y < row8+z+7:
-                temp_data.append(df[x].iloc[y, 3])
-                y += 1
-            try:
-                key = (df[x].iloc[row8+19, 7]).strftime("%d/%m/%Y") + " - " + str(df[x].iloc[y-4, 3])
-                sheet8_data[key] = temp_data
-            except:
-                if z == 1:
-                    dateMissingCounter += 1
-                sheet8_data['blank' + str(dateMissingCounter) + '_' + str(df[x].iloc[y-4, 3])] = temp_data
-    sheet8_df = pd.DataFrame(data=sheet8_data)
-    return sheet8_df
+def read_workbook(file_path, reader):
+    # Cells read from a workbook by reader, or the error message if it cannot be read
+    try:
+        return reader(file_path)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile, ElementTree.ParseError) as error:
+        return str(error) or type(error).__name__
+
+
+def read_workbooks(file_paths):
+    # Yields the cells read from each workbook in file order, read in a pool of processes when there is more than one cpu
+    # The whole sheet is read up to the last column used as the row numbers are not known until the headings are found
+    # A workbook that cannot be read yields the error message instead
+    last_column = qa_layouts.last_column(layout)
+    if cache_dir is None:
+        reader = functools.partial(qa_workbook.read_cells, sheet_name='Monthly QA Sheet', last_row=None,
+                                   last_column=last_column)
+    else:
+        reader = functools.partial(qa_workbook.read_cells_cached, cache_dir=cache_dir, settings=template_version,
+                                   sheet_name='Monthly QA Sheet', last_row=None, last_column=last_column)
+    worker = functools.partial(read_workbook, reader=reader)
+    workers = min(processes or os.cpu_count() or 1, len(file_paths))
+    if workers < 2:
+        yield from map(worker, file_paths)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            yield from pool.imap(worker, file_paths, chunksize=4)
+
+
+def read_known_rows(layouts_file):
+    # Row numbers found before for each template fingerprint
+    try:
+        with open(layouts_file) as known:
+            return {key: {int(n): row for n, row in rows.items()} for key, rows in json.load(known).items()}
+    except (OSError, ValueError):
+        return {}
 
 
-def sheet9():
-    global dateMissingCounter
-    # Isocentric PPS rotation
-    sheet9_data = {}
-    sheet9_data["Date"] = ["Machine", "Max error (cm)"]
-    for x in df:
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        temp_data.append(df[x].iloc[row9+7, 2])
-        try:
-            sheet9_data[(df[x].iloc[row9+9, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet9_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet9_df = pd.DataFrame(data=sheet9_data)
-    return sheet9_df
-
-
-def sheet10():
-    global dateMissingCounter
-    # kV 3D Image Quality
-    sheet10_data = {}
-    sheet10_data["Date"] = ["Machine", "LFOV Uniformity (%)", "LFOV contrast", "LFOV resolution (LP)", "LFOV scale diff. vert (mm)", "LFOV scale diff. horiz. (mm)", "LFOV scale diff. sag. (mm)", "SFOV Uniformity (%)", "SFOV contrast", "SFOV resolution (LP)", "SFOV scale diff. vert (mm)", "SFOV scale diff. horiz. (mm)", "SFOV scale diff. sag. (mm)"]
-    for x in df:
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        temp_data.append(df[x].iloc[row10+9, 3])
-        temp_data.append(df[x].iloc[row10+4, 6])
-        temp_data.append(df[x].iloc[row10+4, 7])
-        temp_data.append(df[x].iloc[row10+4, 11])
-        temp_data.append(df[x].iloc[row10+5, 11])
-        temp_data.append(df[x].iloc[row10+6, 11])
-        temp_data.append(df[x].iloc[row10+15, 3])
-        temp_data.append(df[x].iloc[row10+10, 6])
-        temp_data.append(df[x].iloc[row10+10, 7])
-        temp_data.append(df[x].iloc[row10+10, 11])
-        temp_data.append(df[x].iloc[row10+11, 11])
-        temp_data.append(df[x].iloc[row10+12, 11])
-        try:
-            sheet10_data[(df[x].iloc[row10+21, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet10_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet10_df = pd.DataFrame(data=sheet10_data)
-    return sheet10_df
-
-
-def sheet11():
-    global dateMissingCounter
-    # kV 2D Image Quality
-    sheet11_data = {}
-    sheet11_data["Date"] = ["Machine", "Low contrast OB1", "Resolution OB1", "Low contrast OB2", "Resolution OB2"]
-    for x in df:
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        temp_data.append(df[x].iloc[row11+2, 2])
-        temp_data.append(df[x].iloc[row11+2, 3])
-        temp_data.append(df[x].iloc[row11+3, 2])
-        temp_data.append(df[x].iloc[row11+3, 3])
+def initiate_df():
+    layouts_file = None if cache_dir is None else os.path.join(cache_dir, 'layouts.json')
+    known_rows = {} if layouts_file is None else read_known_rows(layouts_file)
+    plans = {}
+    cache_files = set()
+    read_files = []
+    for file_name, cells in zip(data_files, read_workbooks([path + x for x in data_files])):
+        if isinstance(cells, str):
+            print(file_name + ' could not be read, left out of the results: ' + cells)
+            continue
+        read_files.append(file_name)
+        rows = qa_layouts.detect_rows(cells, layout, known_rows)
+        missing = [str(n) for n, row in rows.items() if row is None]
+        if missing:
+            print(file_name + ': test ' + ', '.join(missing) + ' not found, left out of the results')
+        key = tuple(sorted(rows.items()))
+        if key not in plans:
+            plans[key] = qa_layouts.compile_plan(layout, rows)  # every cell needed by the tests found
+        workbooks.append(qa_layouts.extract(cells, plans[key], rows))
+        cache_files.add(cells.cache_file)
+    data_files[:] = read_files  # kept in step with workbooks
+    if cache_dir is not None:
+        qa_workbook.prune_cache(cache_dir, cache_files | {'layouts.json'})
         try:
-            sheet11_data[(df[x].iloc[row11+5, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet11_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet11_df = pd.DataFrame(data=sheet11_data)
-    return sheet11_df
+            with open(layouts_file, 'w') as known:
+                json.dump(known_rows, known)
+        except OSError as error:
+            print('Template layouts could not be saved: ' + str(error))
 
 
-def sheet12():
+def make_tables():
     global dateMissingCounter
-    # kV output
-    sheet12_data = {}
-    sheet12_data["Date"] = ["Machine", "Chamber SN", "CBCT Head diff. to baseline (%)", "CBCT Pelvis diff. (%)", "OB1 Pelvis diff. (%)", "OB2 Pelvis diff. (%)"]
-    for x in df:
-        temp_data = []
-        temp_data.append(df[x].iloc[4, 2])
-        temp_data.append(df[x].iloc[row12+1, 3])
-        temp_data.append(df[x].iloc[row12+6, 6])
-        temp_data.append(df[x].iloc[row12+7, 6])
-        temp_data.append(df[x].iloc[row12+8, 6])
-        temp_data.append(df[x].iloc[row12+11, 6])
-        try:
-            sheet12_data[(df[x].iloc[row12+16, 7]).strftime("%d/%m/%Y")] = temp_data
-        except:
-            dateMissingCounter += 1
-            sheet12_data['blank' + str(dateMissingCounter)] = temp_data
-    sheet12_df = pd.DataFrame(data=sheet12_data)
-    return sheet12_df
+    # Output table of each test in the layout, built from the cells extracted from all the workbooks
+    tables = []
+    for t in range(len(layout)):
+        table_data, dateMissingCounter = qa_layouts.build_table(layout, t, workbooks, dateMissingCounter)
+        tables.append(table_data)
+    return tables
+
+
+def header_cell(sheet, value):
+    # Cell in the bold bordered style of the pandas to_excel headers
+    cell = WriteOnlyCell(sheet, value=value)
+    cell.font = Font(bold=True)
+    side = Side(style='thin')
+    cell.border = Border(left=side, right=side, top=side, bottom=side)
+    cell.alignment = Alignment(horizontal='center', vertical='top')
+    return cell
+
+
+def write_output(file_name, tables):
+    # Writes each table as a sheet of a write-only workbook in one pass, one row per key as the transposed DataFrames were
+    workbook = Workbook(write_only=True)
+    for test, table in zip(layout, tables):
+        sheet = workbook.create_sheet(test['sheet'])
+        columns = max((len(values) for values in table.values()), default=0)
+        sheet.append([None] + [header_cell(sheet, i) for i in range(columns)])
+        for key, values in table.items():
+            sheet.append([header_cell(sheet, key)] + [None if isinstance(v, float) and v != v else v for v in values])
+    workbook.save(file_name)
+
+
+def write_long_format(file_name):
+    # Saves every measurement as a row of a csv or parquet file
+    measurements = pd.DataFrame(qa_layouts.measurements(layout, workbooks),
+                                columns=['machine', 'test', 'date', 'group', 'parameter', 'value', 'text'])
+    try:
+        if file_name.lower().endswith('.parquet'):
+            measurements.to_parquet(file_name, index=False)
+        else:
+            measurements.to_csv(file_name, index=False)
+    except ImportError as error:
+        print('Long format file not saved: ' + str(error))
+        return
+    print("Measurements saved in: " + file_name)
+
+
+def load_results(database):
+    # Adds the measurements of the workbooks not yet in the results store, or changed since they were loaded
+    connection = qa_results_store.connect(database)
+    loaded = 0
+    for file_name, workbook in zip(data_files, workbooks):
+        file_hash = qa_workbook.file_hash(path + file_name)
+        records = qa_layouts.measurements(layout, [workbook], workbook)
+        loaded += qa_results_store.load_workbook(connection, path + file_name, file_hash, records)
+    connection.close()
+    print(str(loaded) + ' new or changed workbooks saved in: ' + database)
 
 
 # Main Program
-if len(data_files) == 0:
-    ctypes.windll.user32.MessageBoxW(0, "No file found in " + path, "Error!", 0)
-    sys.exit(1)
-else:
-    print(str(len(data_files)) + ' Excel files found in ' + path)
-
-initiate_df()
-sheet1_df = sheet1().T.to_excel('output.xlsx', sheet_name='1.Absolute Dosimetry')
-with pd.ExcelWriter('output.xlsx', engine="openpyxl", mode='a') as writer:
-    sheet2().T.to_excel(writer, sheet_name='2.Dose Linearity')
-    sheet3().T.to_excel(writer, sheet_name='3.Output Dependance')
-    sheet4().T.to_excel(writer, sheet_name='4.Single Energy Layers')
-    sheet5().T.to_excel(writer, sheet_name='5.SOBP')
-    sheet6().T.to_excel(writer, sheet_name='6.Spot size shape position')
-    sheet7().T.to_excel(writer, sheet_name='7.Lateral Uniformity')
-    sheet8().T.to_excel(writer, sheet_name='8.Iso Alignment')
-    sheet9().T.to_excel(writer, sheet_name='9.PPS rotation')
-    sheet10().T.to_excel(writer, sheet_name='10.kV 3D Image Quality')
-    sheet11().T.to_excel(writer, sheet_name='11.kV 2D Image Quality')
-    sheet12().T.to_excel(writer, sheet_name='12.kV Output')
-print("Data saved in: output.xlsx")
+if __name__ == '__main__':
+    # data_files is in modified time order, the worker processes import this file without running the main program
+    data_files = [f for f in sorted(os.listdir(path), key=lambda x: os.path.getmtime(os.path.join(path, x))) if (f.lower().endswith('.xlsx'))]
+    if len(data_files) == 0:
+        ctypes.windll.user32.MessageBoxW(0, "No file found in " + path, "Error!", 0)
+        sys.exit(1)
+    else:
+        print(str(len(data_files)) + ' Excel files found in ' + path)
+
+    initiate_df()
+    write_output('output.xlsx', make_tables())
+    print("Data saved in: output.xlsx")
+    if long_format_file is not None:
+        write_long_format(long_format_file)
+    if results_db is not None:
+        load_results(results_db)
@@ -0,0 +1,319 @@
+'''
+Layouts of the monthly QA templates and the tables extracted from them
+Jamil Lambert 18.10.26
+
+Each test in a template layout is described by the cells it uses, given relative to the test's row number,
+so the same layout is used when rows are added or removed above a test.  find_rows() finds the row number of
+each test in a workbook from its heading, e.g. "1. Absolute dosimetry" in column B, and the first Tolerance or
+Action level cell below it, so workbooks of different template versions can be read together; tests missing
+from a template, e.g. the kV tests 10 to 12 before v3, are left out of that workbook's results.
+compile_plan() turns a layout and the row numbers into one extraction plan of all the cells needed, and
+build_table() makes each output table from the extracted values.  measurements() gives the same values in
+long format, one per measurement.
+
+Cell Key:
+(x, y)
+x = rows below the test's row number (negative for rows above)
+y = column where A = 0, B = 1 etc.
+
+In each test:
+sheet     output sheet name
+number    test number in the heading of the test
+anchor    (text, rows) the row number is the row of the first cell below the heading starting with text plus rows,
+          the row number is the excel row of the word Tolerance/s for tests 1 to 7 as in the v3 grabber
+date      cell of the date the test was performed, used as the key of each row of the table
+headers   header rows from the first workbook: text, a cell, or (cell, text) for the cell value followed by text
+values    the values of a row: MACHINE, a cell or ('difference', cell, cell) for the first cell minus the second
+groups    rows per workbook for tests with several rows, each with values and a key cell added to the date
+baseline  values of a baseline row added the first time each machine is found
+'''
+
+import re
+import math
+import hashlib
+import numbers
+
+MACHINE = 'machine'  # the machine name, cell C5
+MACHINE_CELL = (4, 2)
+ROWS = 'rows'  # the row numbers of the tests in an extracted workbook
+HEADING = re.compile(r'(\d+)\.\s+[A-Za-z]')  # test heading, e.g. 1. Absolute dosimetry
+HEADING_COLUMN = 1
+
+
+def zebra_fields():
+    return [(7, 1)] * 4 + [(11, 1)] * 4 + [(15, 1)] * 4 + [(19, 1)] * 4
+
+
+def lateral_energies():
+    return [(7, 1)] * 5 + [(12, 1)] * 5 + [(17, 1)] * 5
+
+
+def spot_group(row):
+    # Lynx spot size results of one energy, SigmaY diff is read from column C as in the v3 grabber
+    return {'key': (row, 1), 'values': [MACHINE, (row, 1), (row, 2), (row + 1, 2), (row, 3), (row + 1, 2), (row, 4),
+                                        (row, 5), (row, 6), (row, 7)]}
+
+
+def iso_group(z):
+    # XRV isocentre results of one gantry angle
+    return {'key': (z + 3, 3), 'values': [MACHINE, (3, 3)] + [(y, 3) for y in range(z + 3, z + 7)]}
+
+
+V3 = [
+    {'sheet': '1.Absolute Dosimetry', 'number': 1, 'anchor': ('Tolerance', 1), 'date': (19, 7),
+     'headers': {'Date': ['Machine', 'Chamber SN'] + [((7, y), ' MeV Dose Dif. (%)') for y in range(3, 8)]},
+     'values': [MACHINE, (1, 3)] + [(16, y) for y in range(3, 8)]},
+    {'sheet': '2.Dose Linearity', 'number': 2, 'anchor': ('Tolerance', 1), 'date': (11, 7),
+     'headers': {'Date': ['Machine', 'Energy (MeV)'] + [((y, 1), ' MU/spot Dose Dif. (%)') for y in range(4, 10)]},
+     'values': [MACHINE, (0, 2)] + [(y, 4) for y in range(4, 10)]},
+    {'sheet': '3.Output Dependance', 'number': 3, 'anchor': ('Tolerance', 1), 'date': (9, 7),
+     'headers': {'Date': ['Machine', 'Energy (MeV)', 'Max Deviation (%)']},
+     'values': [MACHINE, (-3, 2), (8, 2)]},
+    {'sheet': '4.Single Energy Layers', 'number': 4, 'anchor': ('Tolerance', 1), 'date': (15, 7),
+     'headers': {'0': ['10x10 layer energy (MeV):'] + [(y, 1) for y in range(2, 13) for _ in range(2)],
+                 'Date': ['Machine'] + ['Measured Range (cm)', 'Difference (cm)'] * 11},
+     'values': [MACHINE] + [v for y in range(2, 13) for v in ((y, 5), ('difference', (y, 5), (y, 4)))]},
+    {'sheet': '5.SOBP', 'number': 5, 'anchor': ('Tolerance', 1), 'date': (24, 7),
+     'headers': {'0': ['Field ID:'] + zebra_fields(),
+                 'Date': ['Machine'] + ['R90 (cm)', 'Modulation (cm)', 'Flatness (%)', 'Distal 80-20 (cm)'] * 4},
+     'baseline': [MACHINE] + [(y, 4) for y in range(6, 22)],
+     'values': [MACHINE] + [(y, 5) for y in range(6, 22)]},
+    {'sheet': '6.Spot size shape position', 'number': 6, 'anchor': ('Tolerance', 1), 'date': (20, 7),
+     'key_separator': '_',
+     'headers': {'Date': ['Machine', 'Energy (MeV)', 'SigmaX (mm)', 'SigmaX diff (%)', 'SigmaY (mm)',
+                          'SigmaY diff (%)', 'SkewX', 'SkewY', 'No. points >1mm', 'max. dev. (mm)']},
+     'groups': [spot_group(y + 6) for y in range(0, 12, 2)]},
+    {'sheet': '7.Lateral Uniformity', 'number': 7, 'anchor': ('Tolerance', 1), 'date': (23, 7),
+     'headers': {'0': ['20x20 Layer Energy (MeV)'] + lateral_energies(),
+                 'Date': ['Machine'] + [(y, 3) for y in range(6, 21)],
+                 'Baseline': ['all'] + [(y, 4) for y in range(6, 21)]},
+     'values': [MACHINE] + [(y, 5) for y in range(6, 21)]},
+    {'sheet': '8.Iso Alignment', 'number': 8, 'anchor': ('Tolerance', -1), 'date': (19, 7), 'key_separator': ' - ',
+     'headers': {'Date': ['Machine', 'Energies (MeV)', 'Requested Gantry Angle (°)', 'Max gantry angle error (°)',
+                          'Max gantry tilt (°)', 'Max beam distance to iso (mm)']},
+     'groups': [iso_group(z) for z in range(1, 16, 4)]},
+    {'sheet': '9.PPS rotation', 'number': 9, 'anchor': ('Tolerance', -1), 'date': (9, 7),
+     'headers': {'Date': ['Machine', 'Max error (cm)']},
+     'values': [MACHINE, (7, 2)]},
+    {'sheet': '10.kV 3D Image Quality', 'number': 10, 'anchor': ('Action level', -1), 'date': (21, 7),
+     'headers': {'Date': ['Machine', 'LFOV Uniformity (%)', 'LFOV contrast', 'LFOV resolution (LP)',
+                          'LFOV scale diff. vert (mm)', 'LFOV scale diff. horiz. (mm)', 'LFOV scale diff. sag. (mm)',
+                          'SFOV Uniformity (%)', 'SFOV contrast', 'SFOV resolution (LP)', 'SFOV scale diff. vert (mm)',
+                          'SFOV scale diff. horiz. (mm)', 'SFOV scale diff. sag. (mm)']},
+     'values': [MACHINE, (9, 3), (4, 6), (4, 7), (4, 11), (5, 11), (6, 11), (15, 3), (10, 6), (10, 7), (10, 11),
+                (11, 11), (12, 11)]},
+    {'sheet': '11.kV 2D Image Quality', 'number': 11, 'anchor': ('Action level', -1), 'date': (5, 7),
+     'headers': {'Date': ['Machine', 'Low contrast OB1', 'Resolution OB1', 'Low contrast OB2', 'Resolution OB2']},
+     'values': [MACHINE, (2, 2), (2, 3), (3, 2), (3, 3)]},
+    {'sheet': '12.kV Output', 'number': 12, 'anchor': ('Action level', -1), 'date': (16, 7),
+     'headers': {'Date': ['Machine', 'Chamber SN', 'CBCT Head diff. to baseline (%)', 'CBCT Pelvis diff. (%)',
+                          'OB1 Pelvis diff. (%)', 'OB2 Pelvis diff. (%)']},
+     'values': [MACHINE, (1, 3), (6, 6), (7, 6), (8, 6), (11, 6)]},
+]
+
+LAYOUTS = {'v3': V3}
+
+
+def is_cell(entry):
+    return isinstance(entry, tuple) and len(entry) == 2 and all(isinstance(i, int) for i in entry)
+
+
+def test_cells(test):
+    # Set of the cells a test uses, relative to its row number
+    entries = [test['date']]
+    for header in test.get('headers', {}).values():
+        entries += [entry[0] if isinstance(entry, tuple) and is_cell(entry[0]) else entry for entry in header]
+    for values in [test.get('values', []), test.get('baseline', [])] + [g['values'] for g in test.get('groups', [])]:
+        for entry in values:
+            entries += list(entry[1:]) if isinstance(entry, tuple) and entry[0] == 'difference' else [entry]
+    entries += [group['key'] for group in test.get('groups', [])]
+    return {entry for entry in entries if is_cell(entry)}
+
+
+def last_column(layout):
+    # Last column used by the layout
+    return max(column for test in layout for row, column in test_cells(test) | {MACHINE_CELL})
+
+
+def fingerprint(sheet):
+    # Text and position of the labels in the heading column, the same for all workbooks of a template version
+    labels = [(cell, value) for cell, value in sorted(sheet.cells.items())
+              if cell[1] == HEADING_COLUMN and isinstance(value, str)]
+    return hashlib.sha1(repr(labels).encode('utf-8')).hexdigest()
+
+
+def find_rows(sheet, layout):
+    # Dictionary of test number to row number found from the headings and anchors, None for tests not found
+    cells = [(cell, value) for cell, value in sorted(sheet.cells.items()) if isinstance(value, str)]
+    headings = {}
+    for (row, column), value in cells:
+        match = HEADING.match(value) if column == HEADING_COLUMN else None
+        if match and int(match.group(1)) not in headings:
+            headings[int(match.group(1))] = row
+    rows = {}
+    for test in layout:
+        start = headings.get(test['number'])
+        rows[test['number']] = None
+        if start is None:
+            continue
+        end = min([row for row in headings.values() if row > start], default=math.inf)
+        text, shift = test['anchor']
+        for (row, column), value in cells:
+            if start < row < end and value.startswith(text):
+                rows[test['number']] = row + shift
+                break
+    return rows
+
+
+def anchors_match(sheet, layout, rows):
+    # True if the anchor text of each test is in the row given by rows
+    for test in layout:
+        row = rows.get(test['number'])
+        if row is not None:
+            text, shift = test['anchor']
+            if not any(sheet.iloc[row - shift, column].startswith(text) for column in range(last_column(layout) + 1)
+                       if isinstance(sheet.iloc[row - shift, column], str)):
+                return False
+    return True
+
+
+def detect_rows(sheet, layout, known_rows):
+    '''
+    Row numbers of the tests in a workbook, known_rows is a dictionary of fingerprint to the row numbers found
+    before, so later workbooks of the same template are not scanned, and is updated
+    '''
+    key = fingerprint(sheet)
+    rows = known_rows.get(key)
+    if rows is None or not anchors_match(sheet, layout, rows):
+        rows = find_rows(sheet, layout)
+        known_rows[key] = rows
+    return rows
+
+
+def compile_plan(layout, rows):
+    '''
+    Extraction plan for a layout and row numbers, rows[1] is the row number of test 1 etc.
+    returns a dictionary of each sheet cell needed (row, column), counted from 0, to the list of
+    (test number, cell) it is used as, or MACHINE, tests without a row number are left out
+    '''
+    plan = {MACHINE_CELL: [MACHINE]}
+    for t, test in enumerate(layout):
+        if rows.get(test['number']) is None:
+            continue
+        for row, column in test_cells(test):
+            plan.setdefault((rows[test['number']] + row, column), []).append((t, (row, column)))
+    return plan
+
+
+def extract(sheet, plan, rows):
+    # Values of the plan's cells from a SheetCells, keyed by (test number, cell) and MACHINE, with the row numbers
+    values = {ROWS: rows}
+    for cell, keys in plan.items():
+        value = sheet.iloc[cell]
+        for key in keys:
+            values[key] = value
+    return values
+
+
+def has_test(workbook, test):
+    return workbook[ROWS].get(test['number']) is not None
+
+
+def cell_value(workbook, t, entry):
+    # Value of a values entry for test t of an extracted workbook
+    if entry == MACHINE:
+        return workbook.get(MACHINE, math.nan)
+    if entry[0] == 'difference':
+        return cell_value(workbook, t, entry[1]) - cell_value(workbook, t, entry[2])
+    return workbook.get((t, entry), math.nan)
+
+
+def header_value(workbook, t, entry):
+    if isinstance(entry, str):
+        return entry
+    if is_cell(entry):
+        return cell_value(workbook, t, entry)
+    return str(cell_value(workbook, t, entry[0])) + entry[1]
+
+
+def date_key(workbook, t, test):
+    # The date of the test as dd/mm/yyyy, raises an exception if the date cell is empty or not a date
+    return cell_value(workbook, t, test['date']).strftime("%d/%m/%Y")
+
+
+def build_table(layout, t, workbooks, blank_counter):
+    '''
+    The data of the output table of test t from the extracted workbooks, as the dictionary of columns the
+    sheetN() functions made
+    Rows without a date are given the keys blank1, blank2 etc., blank_counter is the last number used
+    before this table, returns the table and the last number used
+    '''
+    test = layout[t]
+    table = {}
+    baselined_machines = []
+    for i, workbook in enumerate([w for w in workbooks if has_test(w, test)]):
+        if i == 0:
+            for key, header in test.get('headers', {}).items():
+                table[key] = [header_value(workbook, t, entry) for entry in header]
+        if 'baseline' in test and workbook.get(MACHINE) not in baselined_machines:
+            machine = workbook.get(MACHINE, math.nan)
+            table[machine + " Baseline:"] = [cell_value(workbook, t, entry) for entry in test['baseline']]
+            baselined_machines.append(machine)
+        try:
+            date = date_key(workbook, t, test)
+        except Exception:
+            date = None
+            blank_counter += 1
+        if 'groups' in test:
+            for group in test['groups']:
+                suffix = str(cell_value(workbook, t, group['key']))
+                key = 'blank' + str(blank_counter) + '_' + suffix if date is None else \
+                    date + test['key_separator'] + suffix
+                table[key] = [cell_value(workbook, t, entry) for entry in group['values']]
+        else:
+            key = 'blank' + str(blank_counter) if date is None else date
+            table[key] = [cell_value(workbook, t, entry) for entry in test['values']]
+    return table, blank_counter
+
+
+def parameter_names(layout, t, workbook):
+    # Names of the values of test t from the headers of the workbook, the Date header after any rows above it
+    headers = layout[t].get('headers', {})
+    names = [header_value(workbook, t, entry) for entry in headers['Date']]
+    for key, header in headers.items():
+        if key not in ('Date', 'Baseline'):
+            names = [name if i == 0 else str(header_value(workbook, t, entry)) + ' ' + str(name)
+                     for i, (entry, name) in enumerate(zip(header, names))]
+    return names
+
+
+def measurements(layout, workbooks, names_workbook=None):
+    '''
+    Yields each value measured in the workbooks as a dictionary of machine, test, date, group, parameter,
+    value and text, numbers are in value and other values in text
+    Parameter names are taken from names_workbook, by default the first workbook with the test as in the output
+    tables, group is the key cell of tests with several rows per workbook, e.g. the energy, empty cells are left out
+    '''
+    names = []
+    for t, test in enumerate(layout):
+        first = next((w for w in [names_workbook] + workbooks if w is not None and has_test(w, test)), None)
+        names.append(None if first is None else parameter_names(layout, t, first))
+    for workbook in workbooks:
+        machine = workbook.get(MACHINE, math.nan)
+        for t, test in enumerate(layout):
+            if not has_test(workbook, test):
+                continue
+            date = cell_value(workbook, t, test['date'])
+            date = date if hasattr(date, 'strftime') else None
+            for group in test.get('groups', [{'key': None, 'values': test.get('values', [])}]):
+                group_name = '' if group['key'] is None else str(cell_value(workbook, t, group['key']))
+                for entry, parameter in zip(group['values'], names[t]):
+                    if entry == MACHINE:
+                        continue
+                    value = cell_value(workbook, t, entry)
+                    if isinstance(value, float) and math.isnan(value):
+                        continue
+                    number = isinstance(value, numbers.Number) and not isinstance(value, bool)
+                    yield {'machine': machine, 'test': test['sheet'], 'date': date, 'group': group_name,
+                           'parameter': parameter, 'value': value if number else math.nan,
+                           'text': None if number else str(value)}
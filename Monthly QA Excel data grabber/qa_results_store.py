@@ -0,0 +1,130 @@
+'''
+Results store of the monthly QA measurements across years and sites
+Jamil Lambert 18.10.26
+
+Every measurement extracted by myqa_yearly_RCC_v3.py is saved in an SQLite database as one row of machine, test,
+parameter, group, date and value, indexed by machine, test and date, so trends over many years can be queried
+without reading the workbooks again.  Workbooks are keyed by a hash of their contents so each is loaded once: a
+workbook already in the store is skipped even when it is a copy in another folder, and a workbook that has changed
+since it was loaded from the same path has its measurements replaced.
+
+Usage:
+python qa_results_store.py qa_results.db test parameter [machine] [since]
+prints the measurements of a parameter, e.g.
+python qa_results_store.py qa_results.db "1.Absolute Dosimetry" "200 MeV Dose Dif. (%)" all 2020-01-01
+'''
+
+import os
+import sys
+import sqlite3
+import datetime
+
+SCHEMA_VERSION = 1  # stored as the user_version of the database, 0 for the earlier stores keyed by path
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS workbooks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    file_hash TEXT UNIQUE NOT NULL,
+    loaded TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    workbook_id INTEGER NOT NULL REFERENCES workbooks(id),
+    machine TEXT,
+    test TEXT NOT NULL,
+    parameter TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    date TEXT,
+    value REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS measurements_machine_test_date ON measurements (machine, test, date);
+CREATE INDEX IF NOT EXISTS measurements_test_parameter_date ON measurements (test, parameter, date);
+CREATE INDEX IF NOT EXISTS measurements_date ON measurements (date);
+CREATE INDEX IF NOT EXISTS measurements_workbook ON measurements (workbook_id);
+CREATE INDEX IF NOT EXISTS workbooks_path ON workbooks (path);
+'''
+# Rekeys a store made before SCHEMA_VERSION 1 by file hash, copies of a workbook loaded from other folders are removed
+UPGRADE = '''
+CREATE TABLE workbooks_by_hash (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    file_hash TEXT UNIQUE NOT NULL,
+    loaded TEXT NOT NULL
+);
+INSERT INTO workbooks_by_hash (id, path, file_hash, loaded)
+    SELECT id, path, file_hash, loaded FROM workbooks WHERE id IN (SELECT MIN(id) FROM workbooks GROUP BY file_hash);
+DELETE FROM measurements WHERE workbook_id NOT IN (SELECT id FROM workbooks_by_hash);
+DROP TABLE workbooks;
+ALTER TABLE workbooks_by_hash RENAME TO workbooks;
+'''
+
+
+def connect(database):
+    # Opens the results database, creating the tables and indexes if needed and upgrading an older store
+    connection = sqlite3.connect(database)
+    if connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'workbooks'").fetchone():
+            connection.executescript('BEGIN;' + UPGRADE + 'COMMIT;')
+        connection.executescript(SCHEMA)
+        connection.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+    else:
+        connection.executescript(SCHEMA)
+    return connection
+
+
+def load_workbook(connection, path, file_hash, measurements):
+    '''
+    Saves the measurements of a workbook, as given by qa_layouts.measurements(), keyed by the hash of its contents,
+    the path is only recorded.  Measurements saved from an earlier version of the workbook at the same path are removed
+    returns False if a workbook with the same contents is already in the store, loaded from any folder
+    '''
+    path = os.path.abspath(path)
+    loaded = datetime.datetime.now().isoformat(timespec='seconds')
+    with connection:
+        for (workbook_id,) in connection.execute('SELECT id FROM workbooks WHERE path = ? AND file_hash != ?',
+                                                 (path, file_hash)).fetchall():
+            connection.execute('DELETE FROM measurements WHERE workbook_id = ?', (workbook_id,))
+            connection.execute('DELETE FROM workbooks WHERE id = ?', (workbook_id,))
+        if connection.execute('SELECT 1 FROM workbooks WHERE file_hash = ?', (file_hash,)).fetchone():
+            return False
+        workbook_id = connection.execute('INSERT INTO workbooks (path, file_hash, loaded) VALUES (?, ?, ?)',
+                                         (path, file_hash, loaded)).lastrowid
+        connection.executemany(
+            'INSERT INTO measurements (workbook_id, machine, test, parameter, grp, date, value, text) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((workbook_id, None if m['machine'] != m['machine'] else str(m['machine']), m['test'], m['parameter'],
+              m['group'], None if m['date'] is None else m['date'].strftime('%Y-%m-%d'),
+              None if m['value'] != m['value'] else m['value'], m['text']) for m in measurements))
+    return True
+
+
+def query(connection, test, parameter, machine=None, since=None, until=None):
+    # List of (machine, date, group, value, text) of a parameter in date order, dates as yyyy-mm-dd
+    sql = 'SELECT machine, date, grp, value, text FROM measurements WHERE test = ? AND parameter = ?'
+    arguments = [test, parameter]
+    if machine is not None:
+        sql += ' AND machine = ?'
+        arguments.append(machine)
+    if since is not None:
+        sql += ' AND date >= ?'
+        arguments.append(since)
+    if until is not None:
+        sql += ' AND date <= ?'
+        arguments.append(until)
+    return connection.execute(sql + ' ORDER BY date, machine, grp', arguments).fetchall()
+
+
+if __name__ == '__main__':
+    if not 4 <= len(sys.argv) <= 6:
+        print('Invalid input arguments, example usage: python qa_results_store.py qa_results.db '
+              '"1.Absolute Dosimetry" "200 MeV Dose Dif. (%)" all 2020-01-01')
+        sys.exit(1)
+    if not os.path.isfile(sys.argv[1]):
+        print('Results database ' + sys.argv[1] + ' not found')
+        sys.exit(1)
+    machine = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != 'all' else None
+    since = sys.argv[5] if len(sys.argv) > 5 else None
+    connection = connect(sys.argv[1])
+    for machine, date, group, value, text in query(connection, sys.argv[2], sys.argv[3], machine, since):
+        print('{}\t{}\t{}\t{}'.format(machine, date or 'no date', group, text if value is None else value))
+    connection.close()
@@ -0,0 +1,218 @@
+'''
+Reads selected cells from the monthly QA excel workbooks
+Jamil Lambert 18.10.26
+
+Only the xml of the worksheet needed is read from the .xlsx file and it is streamed row by row, stopping
+after the last row needed, so the rest of the workbook, the other worksheets and the cell styles (apart
+from the number formats needed to recognise dates) are never loaded.  Values are returned as read_excel
+gives them: whole numbers as int, dates as datetime and empty cells or #N/A as NaN.
+
+The cells read can be cached, keyed by a hash of the workbook contents and of the settings used to read it,
+so unchanged workbooks are not read again and changing the settings reads them all again.
+
+Cell Key:
+(x, y)
+x = row-1
+y = column where A = 0, B = 1 etc.
+'''
+
+import os
+import math
+import pickle
+import hashlib
+import zipfile
+import posixpath
+import datetime
+import xml.etree.ElementTree as ElementTree
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
+from openpyxl.utils.datetime import from_excel, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+
+MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+PACKAGE_RELATIONSHIP = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+EXTRACTION_VERSION = 1  # changes the cache keys, increase if the values returned by read_cells() change
+# Text read_excel treats as an empty cell, including the #N/A of the template formulas
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A',
+             'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+
+class SheetCells:
+    '''
+    The cells read from a worksheet, indexed with .iloc[row, column] like the DataFrame read_excel gives
+    Empty cells and cells that were not read are NaN
+    '''
+    def __init__(self, cells, cache_file=None):
+        self.cells = cells
+        self.cache_file = cache_file  # cache file name the cells were read from or saved to
+        self.iloc = self
+
+    def __getitem__(self, cell):
+        return self.cells.get(cell, math.nan)
+
+
+def sheet_path(workbook, sheet_name):
+    # Path in the .xlsx zip file of the xml of the named worksheet
+    root = ElementTree.fromstring(workbook.read('xl/workbook.xml'))
+    for sheet in root.iter(MAIN + 'sheet'):
+        if sheet.get('name') == sheet_name:
+            relationship_id = sheet.get(RELATIONSHIP)
+            break
+    else:
+        raise ValueError('Worksheet named ' + sheet_name + ' not found')
+    for relationship in ElementTree.fromstring(workbook.read('xl/_rels/workbook.xml.rels')).iter(PACKAGE_RELATIONSHIP):
+        if relationship.get('Id') == relationship_id:
+            target = relationship.get('Target')
+            return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+    raise ValueError('Worksheet ' + sheet_name + ' has no xml file in the workbook')
+
+
+def shared_strings(workbook):
+    # List of the shared strings, rich text runs are joined
+    try:
+        source = workbook.open('xl/sharedStrings.xml')
+    except KeyError:
+        return []
+    strings = []
+    with source:
+        for event, element in ElementTree.iterparse(source):
+            if element.tag == MAIN + 'si':
+                text = element.find(MAIN + 't')
+                if text is None:
+                    strings.append(''.join(run.findtext(MAIN + 't', '') for run in element.iter(MAIN + 'r')))
+                else:
+                    strings.append(text.text or '')
+                element.clear()
+    return strings
+
+
+def date_styles(workbook):
+    # Set of the cell style indexes with a date number format
+    try:
+        source = workbook.open('xl/styles.xml')
+    except KeyError:
+        return set()
+    formats = dict(BUILTIN_FORMATS)
+    styles = []
+    with source:
+        for event, element in ElementTree.iterparse(source):
+            if element.tag == MAIN + 'numFmt':
+                formats[int(element.get('numFmtId'))] = element.get('formatCode')
+            elif element.tag == MAIN + 'cellXfs':
+                styles = [int(xf.get('numFmtId', 0)) for xf in element.findall(MAIN + 'xf')]
+                break
+    return {i for i, format_id in enumerate(styles) if format_id in formats and is_date_format(formats[format_id])}
+
+
+def cell_value(element, strings, dates, epoch):
+    # Value of a <c> element as read_excel gives it, None for an empty cell
+    cell_type = element.get('t', 'n')
+    if cell_type == 'inlineStr':
+        value = ''.join(text.text or '' for text in element.iter(MAIN + 't'))
+    else:
+        value = element.findtext(MAIN + 'v')
+        if not value:
+            return None  # also a formula without a cached value, as saved by openpyxl
+        if cell_type == 's':
+            value = strings[int(value)]
+        elif cell_type == 'b':
+            return bool(int(value))
+        elif cell_type == 'd':
+            return datetime.datetime.fromisoformat(value)
+        elif cell_type == 'n':
+            number = float(value)
+            if int(element.get('s', 0)) in dates:
+                return from_excel(number, epoch)
+            return int(number) if number.is_integer() else number
+    return None if value in NA_VALUES else value
+
+
+def read_cells(file_path, sheet_name, last_row, last_column, cells=None):
+    '''
+    Reads the cells of the named worksheet up to last_row and last_column, both counted from 0, last_row None
+    reads to the end of the worksheet
+    If cells is a set of (row, column) only those cells are kept, returns a SheetCells
+    '''
+    values = {}
+    with zipfile.ZipFile(file_path) as workbook:
+        path = sheet_path(workbook, sheet_name)
+        strings = shared_strings(workbook)
+        dates = date_styles(workbook)
+        epoch = CALENDAR_WINDOWS_1900
+        properties = ElementTree.fromstring(workbook.read('xl/workbook.xml')).find(MAIN + 'workbookPr')
+        if properties is not None and properties.get('date1904') in ('1', 'true'):
+            epoch = CALENDAR_MAC_1904
+        row = -1
+        with workbook.open(path) as source:
+            for event, element in ElementTree.iterparse(source):
+                if element.tag != MAIN + 'row':
+                    continue
+                row = int(element.get('r', row + 2)) - 1  # r is optional, rows without it follow the last row
+                if last_row is not None and row > last_row:
+                    break
+                column = -1
+                for cell in element.iter(MAIN + 'c'):
+                    if cell.get('r') is None:
+                        column += 1
+                    else:
+                        column = column_index_from_string(coordinate_from_string(cell.get('r'))[0]) - 1
+                    key = (row, column)
+                    if key[1] > last_column or (cells is not None and key not in cells):
+                        continue
+                    value = cell_value(cell, strings, dates, epoch)
+                    if value is not None:
+                        values[key] = value
+                element.clear()
+    return SheetCells(values)
+
+
+def file_hash(file_path):
+    # sha1 hash of the workbook contents
+    contents_hash = hashlib.sha1()
+    with open(file_path, 'rb') as workbook:
+        for block in iter(lambda: workbook.read(1024 * 1024), b''):
+            contents_hash.update(block)
+    return contents_hash.hexdigest()
+
+
+def cache_file_name(file_path, settings):
+    # Cache file name made from hashes of the workbook contents and the settings
+    settings_hash = hashlib.sha1(repr((EXTRACTION_VERSION, settings)).encode('utf-8'))
+    return file_hash(file_path) + '_' + settings_hash.hexdigest()[:16] + '.pkl'
+
+
+def read_cells_cached(file_path, cache_dir, settings, sheet_name, last_row, last_column, cells=None):
+    '''
+    read_cells() with the result cached in cache_dir
+    settings is anything that changes which cells are needed, e.g. the template version and row numbers,
+    together with the arguments of read_cells() it is part of the cache key
+    '''
+    cache_file = cache_file_name(file_path, (settings, sheet_name, last_row, last_column,
+                                             None if cells is None else sorted(cells)))
+    cache_path = os.path.join(cache_dir, cache_file)
+    try:
+        with open(cache_path, 'rb') as cached:
+            return SheetCells(pickle.load(cached), cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    sheet = read_cells(file_path, sheet_name, last_row, last_column, cells)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + '.tmp', 'wb') as cached:
+            pickle.dump(sheet.cells, cached)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as error:
+        print('Extraction cache could not be written: ' + str(error))
+    sheet.cache_file = cache_file
+    return sheet
+
+
+def prune_cache(cache_dir, used):
+    # Removes the cache files not in used, left by changed or removed workbooks or by older settings
+    removed = 0
+    if os.path.isdir(cache_dir):
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and entry.name not in used:
+                os.remove(entry.path)
+                removed += 1
+    return removed
@@ -1,30 +1,93 @@
 """Analyses Lynx images from the kV Obliques and Orthogonal X-Rays on the ProteusONE
 
 Required:
-          baseline.npy - baseline values stored in a numpy array file
+          baseline.npy - baseline values stored in a numpy array file, the baseline of each image is taken from
+          the baseline files in .\\bin\\ by its device serial number, this file is used when it has none
           opg files of the lynx images stored in the path specified below
 Options:
-          -d turn on debugging, outputs the quadrant pixel values and region mean values
+          -d turn on debugging, outputs the quadrant pixel values, region mean values and image statistics
+          -n analyse the dicom files directly instead of the opg files, requires pydicom
+          -c clear the decoded image cache and exit
+          -b batch mode, images are stacked and analysed together with vectorised numpy reductions
+          --jobs N reads and analyses the images in N parallel processes
+          -w watch the measurements folder and analyse each new file as soon as it has been saved
+          -p record the time, cpu time, bytes read and peak memory of each stage, printed as a summary
+             and saved in .\\bin\\metrics.jsonl
+          --protocol NAME evaluates the regions of a roi.py protocol, uniformity or symmetry, on each image, the
+             results are printed and added to .\\bin\\history.dat.roi.csv
 
 29.03.2021 Jamil Lambert
 14.04.21 v3 JL changed quadrants to determine which source was used
-13.07.21 v3.1 JL changed output formatting including in history file, added -d debugging option"""
+13.07.21 v3.1 JL changed output formatting including in history file, added -d debugging option
+18.10.26 v3.2 opg files decoded in one pass using the image size, separator and data factor from the header
+18.10.26 v3.3 dicom files can be read directly with pydicom without running dcmodify and dicom2opg
+18.10.26 v3.4 decoded images cached as memory mapped .npy files so re-runs skip the parsing
+18.10.26 v3.5 added -b batch mode analysing a stack of images at once
+18.10.26 v3.6 added --jobs option to read and analyse images in parallel processes
+18.10.26 v3.7 history saved in the append-only history_store.py format, history.npy is migrated on first run
+18.10.26 v3.8 dose drift warnings from the rolling statistics in dose_trend.py
+18.10.26 v3.9 added -w watch mode that keeps running and analyses new measurements as they are saved
+18.10.26 v3.10 baseline chosen for each image from its device serial with baseline_registry.py
+18.10.26 v3.11 region sums and means from the summed-area tables in roi.py, any region set can be added
+18.10.26 v3.12 added -p performance metrics of each stage with stage_metrics.py
+18.10.26 v3.13 multi-body opg and multi-frame dicom files streamed one frame at a time, each frame analysed
+18.10.26 v3.14 pixels held as uint16 when they are whole numbers, sums in integers, XrayImage uses __slots__
+18.10.26 v3.15 saturated and zero pixels, min, max, background and noise from one histogram of each image, saved
+               in the history
+18.10.26 v3.16 dose trends use the tolerance and baseline of each result, Fail results left out of them
+18.10.26 v3.17 fixed regions summed from slices again, roi.py summed-area tables used for the --protocol regions"""
 
-import sys, os, re
+import sys, os, time, hashlib, functools, multiprocessing
 import numpy as np
+import history_store
+import dose_trend
+import baseline_registry
+import roi
+import stage_metrics
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
 
+CACHE_SIZE_LIMIT = 500 * 1024 * 1024  # bytes of decoded images kept in the cache before the oldest are removed
+CACHE_FORMAT = 2  # part of every cache file name, raised when the cached arrays change so old entries are not read
+BATCH_SIZE = 100  # images stacked into one array in batch mode
+WATCH_INTERVAL = 1  # seconds between checks of the measurements folder in watch mode
+WATCH_SETTLE_TIME = 2  # seconds a new file's size and modified time must be unchanged before it is analysed
+RESULT_DTYPE = np.dtype([('file', 'U30'), ('source', 'U11'), ('BL', float), ('BR', float), ('TL', float),
+                         ('TR', float), ('CTR', float), ('dose_diff', float), ('whole_mean', float),
+                         ('left_mean', float), ('right_mean', float)])  # fields returned by XrayImage.data_string
+SATURATION = 1023  # pixel value of a saturated Lynx pixel
+STATISTICS = ('saturated_pixels', 'zero_pixels', 'min_pixel', 'max_pixel', 'mean_pixel', 'background',
+              'noise')  # keys of the dictionary returned by image_statistics()
 
 
 class XrayImage:
-    """Holds a single xray image pixel data, analysis functions and results"""
-    def __init__(self, file_path):
+    """Holds a single xray image pixel data, analysis functions and results
+
+    The pixel data is a uint16 array for the 10 bit Lynx images, see compact_pixels(), the left and right
+    arrays are views of it"""
+    __slots__ = ('right_mean', 'left_mean', 'CTR', 'whole_mean', 'right_array', 'left_array', 'whole_array',
+                 'roi_results', 'x_axis', 'y_axis', 'pixel_spacing', 'serial_number', 'rescale_slope',
+                 'rescale_intercept', 'startR', 'endR', 'startL', 'endL', 'BR', 'TR', 'BL', 'TL', 'xray_source_1',
+                 'xray_source_2', 'dose_diff_1', 'dose_diff_2', 'saturated_pixels', 'statistics', 'constants',
+                 'metrics', 'bytes_read', 'frame_index', 'frame_count', 'plane_position')
+
+    def __init__(self, file_path, cache_dir=None):
         self.right_mean = 0
         self.left_mean = 0
         self.CTR = 0
         self.whole_mean = 0
         self.right_array = None
         self.left_array = None
-        self.whole_array = np.empty(shape=(600, 600))
+        self.whole_array = None
+        self.roi_results = None  # protocol name, region statistics and summary values, see roi.evaluate()
+        self.x_axis = None
+        self.y_axis = None
+        self.pixel_spacing = None
+        self.serial_number = None
+        self.rescale_slope = None
+        self.rescale_intercept = None
         self.startR = 500
         self.endR = 600
         self.startL = 1
@@ -37,56 +100,160 @@ class XrayImage:
         self.xray_source_2 = 'None'
         self.dose_diff_1 = 0
         self.dose_diff_2 = 0
-        self.load_opg_file(file_path)    
+        self.saturated_pixels = 0
+        self.statistics = None
+        self.constants = None
+        self.metrics = []
+        self.bytes_read = 0  # from the image file and the image cache
+        self.frame_index = 0  # body of a multi-body opg file or frame of a multi-frame dicom file
+        self.frame_count = 1
+        self.plane_position = None
+        if file_path is None:
+            return  # the pixel data is set by load_frame()
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, image_cache_key(file_path))
+            self.bytes_read = os.path.getsize(file_path)  # read to make the cache key
+            if self.load_cached_image(cache_path):
+                self.bytes_read += self.whole_array.nbytes
+                return
+        if file_path.lower().endswith('.dcm'):
+            self.load_dcm_file(file_path)
+        else:
+            self.load_opg_file(file_path)
+        self.bytes_read += os.path.getsize(file_path)
+        if cache_path is not None:
+            self.save_cached_image(cache_path)
 
     def load_opg_file(self, file_path):
-        """Reads in an xray image data for the file input"""
-        pixel_data = np.empty(shape=(600, 600))
-        with open(file_path) as opg_file:
-            for i, line in enumerate(opg_file):
-                if i == 26 and not line.startswith("<asciibody>"):
-                    print('format missmatch in opg file, line 27 =\"' +
-                        line + '\" expected \"<asciibody>\"')
-                    return
-                elif 30 < i < 631:  # lines 31 to 631 contain the pixel data
-                    new_line = [p for p in re.split(
-                        "\s|,|;", line) if p]  # type: ignore
-                    pixel_data[i - 31] = np.array(
-                        new_line[1:])  # the first entry on the line is the y position and needs to be removed
-        self.whole_array = np.array(pixel_data).astype(float)    
-        
+        """Reads in an xray image data for the file input
+
+        The image size, separator, data factor and coordinate axes are read from the <asciiheader> and the
+        first <asciibody> is decoded in one pass, raises ValueError if the file does not match its header"""
+        frames = read_opg_frames(file_path)
+        try:
+            self.load_frame(next(frames))
+        finally:
+            frames.close()
+        self.frame_count = 1
+
+    def load_frame(self, frame):
+        """Sets the pixel data, axes and frame details from a frame dictionary of read_frames()"""
+        self.whole_array = frame['pixels']
+        self.x_axis = frame['x_axis']
+        self.y_axis = frame['y_axis']
+        self.pixel_spacing = frame.get('pixel_spacing')
+        if self.pixel_spacing is None and self.x_axis.size > 1:
+            self.pixel_spacing = abs(self.x_axis[1] - self.x_axis[0])
+        self.serial_number = frame.get('serial_number')
+        self.rescale_slope = frame.get('rescale_slope')
+        self.rescale_intercept = frame.get('rescale_intercept')
+        self.frame_index = frame['index']
+        self.frame_count = frame['count']
+        self.plane_position = frame.get('plane_position')
+
+    def frame_name(self, file_name):
+        """returns the file name for a single image, or the file name ending in #frame number for a frame of a
+        multi-frame file, cut to fit the 30 characters of the results"""
+        if self.frame_count == 1:
+            return file_name
+        suffix = '#' + str(self.frame_index + 1)
+        return os.path.splitext(file_name)[0][:30 - len(suffix)] + suffix
+
+    def load_dcm_file(self, file_path):
+        """Reads in an xray image data directly from a Lynx dicom file
+
+        The first frame is decoded by read_dcm_frames(), raises ValueError if the file cannot be read"""
+        frames = read_dcm_frames(file_path)
+        try:
+            frame = next(frames, None)
+        finally:
+            frames.close()
+        if frame is None:
+            raise ValueError('dicom file ' + file_path + ' could not be read: it has no frames')
+        self.load_frame(frame)
+        self.frame_count = 1
+
+    def load_cached_image(self, cache_path):
+        """Loads the pixel data memory mapped from the image cache, returns False if the image is not cached"""
+        try:
+            pixel_data = np.load(cache_path + '.npy', mmap_mode='r')
+            with np.load(cache_path + '_meta.npz') as meta:
+                self.x_axis = meta['x_axis']
+                self.y_axis = meta['y_axis']
+                pixel_spacing, rescale_slope, rescale_intercept = meta['scales']
+                serial_number = str(meta['serial_number'])
+        except (OSError, ValueError, KeyError):
+            return False
+        self.whole_array = np.asarray(pixel_data)
+        self.pixel_spacing = None if np.isnan(pixel_spacing) else float(pixel_spacing)
+        self.rescale_slope = None if np.isnan(rescale_slope) else float(rescale_slope)
+        self.rescale_intercept = None if np.isnan(rescale_intercept) else float(rescale_intercept)
+        self.serial_number = serial_number or None
+        try:
+            os.utime(cache_path + '.npy')  # the modified time orders the cache for least recently used eviction
+        except OSError:
+            pass  # removed by another run's eviction, the pixel data is already mapped
+        return True
+
+    def save_cached_image(self, cache_path):
+        """Saves the decoded pixel data and axes to the image cache and removes old entries over the size limit"""
+        scales = [np.nan if v is None else v for v in (self.pixel_spacing, self.rescale_slope, self.rescale_intercept)]
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + '_meta.tmp', 'wb') as meta_file:
+                np.savez(meta_file, x_axis=self.x_axis, y_axis=self.y_axis, scales=np.array(scales, dtype=float),
+                         serial_number=np.array(self.serial_number or ''))
+            with open(cache_path + '.tmp', 'wb') as cache_file:
+                np.save(cache_file, np.ascontiguousarray(self.whole_array))
+            os.replace(cache_path + '_meta.tmp', cache_path + '_meta.npz')
+            os.replace(cache_path + '.tmp', cache_path + '.npy')  # written last so a cache hit always has its meta file
+        except OSError as error:
+            print('Image cache could not be written: ' + str(error))
+            return
+        evict_image_cache(os.path.dirname(cache_path), CACHE_SIZE_LIMIT)
+
     def read_quadrants(self, c, angle):
         """Reads in the data in each quadrant of xray pixel data
         
         If taken in Lynx2D the images are rotated 180 compared to myQA, the opg file can be renamed
         from _i_000.opg to _i_180.opg and this functino will correct for the rotation"""
+        rows, columns = self.whole_array.shape
         if angle == 180:
-            self.TL = np.sum(self.whole_array[0:100, 0:100])
-            self.BL = np.sum(self.whole_array[500:600, 0:100])
-            self.TR = np.sum(self.whole_array[0:100, 500:600])
-            self.BR = np.sum(self.whole_array[500:600, 500:600])
+            self.TL = self.whole_array[0:100, 0:100].sum()
+            self.BL = self.whole_array[rows - 100:rows, 0:100].sum()
+            self.TR = self.whole_array[0:100, columns - 100:columns].sum()
+            self.BR = self.whole_array[rows - 100:rows, columns - 100:columns].sum()
             self.startL = c[7] - 1
             self.endL = c[8]
             self.startR = c[9] - 1
             self.endR = c[10]
         else:
-            self.TL = np.sum(self.whole_array[500:600, 500:600])
-            self.BL = np.sum(self.whole_array[0:100, 500:600])
-            self.TR = np.sum(self.whole_array[500:600, 0:100])
-            self.BR = np.sum(self.whole_array[0:100, 0:100])
-            self.startL = 600 - c[8]
-            self.endL = 600 - c[7] + 1
-            self.startR = 600 - c[10]
-            self.endR = 600 - c[9] + 1   
-            
+            self.TL = self.whole_array[rows - 100:rows, columns - 100:columns].sum()
+            self.BL = self.whole_array[0:100, columns - 100:columns].sum()
+            self.TR = self.whole_array[rows - 100:rows, 0:100].sum()
+            self.BR = self.whole_array[0:100, 0:100].sum()
+            self.startL = columns - c[8]
+            self.endL = columns - c[7] + 1
+            self.startR = columns - c[10]
+            self.endR = columns - c[9] + 1
+
     def calculate_means(self):
-        """Calculates the means and sub arrays used in the dose difference calculation"""
-        self.CTR = np.sum(self.whole_array[150:450, 150:450])
-        self.left_array = np.array(self.whole_array[:, self.startL:self.endL])
-        self.right_array = np.array(self.whole_array[:, self.startR:self.endR])
-        self.whole_mean = np.mean(self.whole_array)
-        self.left_mean = np.mean(self.left_array)
-        self.right_mean = np.mean(self.right_array)
+        """Calculates the means and sub arrays used in the dose difference calculation
+
+        The left and right arrays are views of the whole array, the means are taken from the sums, which are
+        exact for the uint16 pixels"""
+        rows, columns = self.whole_array.shape
+        self.CTR = self.whole_array[rows // 4:rows * 3 // 4, columns // 4:columns * 3 // 4].sum()
+        self.left_array = self.whole_array[:, self.startL:self.endL]
+        self.right_array = self.whole_array[:, self.startR:self.endR]
+        self.whole_mean = self.whole_array.sum() / self.whole_array.size
+        self.left_mean = self.left_array.sum() / self.left_array.size
+        self.right_mean = self.right_array.sum() / self.right_array.size
+
+    def calculate_roi_results(self, protocol):
+        """Evaluates the regions of a protocol in roi.PROTOCOLS from the summed-area tables of the image"""
+        self.roi_results = (protocol,) + roi.evaluate(protocol, self.whole_array)
 
 
     def calculate_dose_diff(self, c):
@@ -126,44 +293,548 @@ class XrayImage:
             dose_diff = self.dose_diff_2
         return file_name[:30], xray_source, self.BL, self.BR, self.TL, self.TR, self.CTR, dose_diff, self.whole_mean, self.left_mean, self.right_mean
 
+    def calculate_statistics(self):
+        """Calculates the image statistics with image_statistics(), returns the number of saturated pixels"""
+        self.statistics = image_statistics(self.whole_array)
+        self.saturated_pixels = self.statistics['saturated_pixels']
+        return self.saturated_pixels
+
     def check_saturation(self, file_name):
         """Checks if the xray image is saturated and prints a message if it is"""
-        if np.max(self.whole_array) == 1023:
-            saturated_pixels = np.count_nonzero(self.whole_array == 1023)
-            print('\nWarning! {:.0f} saturated pixels in image: {:<22}\n'.format(saturated_pixels, file_name))
+        if self.calculate_statistics():
+            print_saturation(self.saturated_pixels, file_name)
+
+
+
+def parse_opg_header(text, file_path):
+    """returns a dictionary of the <asciiheader> fields needed to decode the opg body"""
+    start = text.find('<asciiheader>')
+    end = text.find('</asciiheader>')
+    if start < 0 or end < start:
+        raise ValueError('format missmatch in opg file ' + file_path + ', no <asciiheader> section found')
+    fields = {}
+    for line in text[start + len('<asciiheader>'):end].splitlines():
+        key, _, value = line.partition(':')
+        fields[key.strip()] = value.strip()
+    header = {}
+    try:
+        header['No. of Columns'] = int(fields['No. of Columns'])
+        header['No. of Rows'] = int(fields['No. of Rows'])
+        header['Data Factor'] = float(fields.get('Data Factor', 1))
+        header['Number of Bodies'] = int(fields.get('Number of Bodies', 1))
+    except KeyError as missing:
+        raise ValueError('format missmatch in opg file ' + file_path + ', header has no ' + str(missing) + ' field')
+    except ValueError:
+        raise ValueError('format missmatch in opg file ' + file_path + ', header sizes or data factor are not numbers')
+    if header['No. of Columns'] < 1 or header['No. of Rows'] < 1:
+        raise ValueError('format missmatch in opg file ' + file_path + ', header image size is ' +
+                         fields['No. of Columns'] + 'x' + fields['No. of Rows'])
+    separator = fields.get('Separator', '","').strip('"')
+    header['Separator'] = '\t' if separator in ('', '[TAB]', '\\t') else separator
+    return header
+
+
+def parse_opg_body(body, header, file_path):
+    """returns the x axis, y axis and pixel data decoded from the text inside an <asciibody> of an opg file
+
+    The body holds a plane position, the X[mm] axis line, a Y[mm] line and then one line per row where the
+    first entry is the y position followed by the pixel values, each row is checked to have all its values"""
+    columns = header['No. of Columns']
+    rows = header['No. of Rows']
+    x_start = body.find('X[mm]')
+    y_start = body.find('Y[mm]', x_start)
+    if x_start < 0 or y_start < 0:
+        raise ValueError('format missmatch in opg file ' + file_path + ', <asciibody> has no X[mm] and Y[mm] axis lines')
+    separator = header['Separator']
+    x_line = body[x_start + len('X[mm]'):y_start].replace(separator, ' ')
+    pixel_text = body[body.find('\n', y_start) + 1:].replace(separator, ' ')
+    try:
+        x_axis = np.fromstring(x_line, sep=' ')
+        values = np.fromstring(pixel_text, sep=' ')
+    except ValueError as error:  # numpy 2 raises on text that is not a number
+        raise ValueError('format missmatch in opg file ' + file_path + ', <asciibody> holds values that are not '
+                         'numbers, ' + str(error))
+    if x_axis.size != columns:
+        raise ValueError('format missmatch in opg file ' + file_path + ', X[mm] axis has ' + str(x_axis.size) +
+                         ' entries, header No. of Columns = ' + str(columns))
+    if values.size != rows * (columns + 1):
+        raise ValueError('format missmatch in opg file ' + file_path + ', <asciibody> has ' + str(values.size) +
+                         ' values, expected ' + str(rows) + ' rows of ' + str(columns + 1) + ' (y position and ' +
+                         str(columns) + ' pixels)')
+    sizes = line_sizes(pixel_text)
+    bad_rows = np.flatnonzero(sizes != columns + 1)
+    if bad_rows.size:
+        raise ValueError('format missmatch in opg file ' + file_path + ', <asciibody> row ' + str(bad_rows[0] + 1) +
+                         ' has ' + str(sizes[bad_rows[0]]) + ' values, expected ' + str(columns + 1) +
+                         ' (y position and ' + str(columns) + ' pixels)')
+    values = values.reshape(rows, columns + 1)
+    return x_axis, values[:, 0].copy(), values[:, 1:]  # the y axis copied so it does not keep the pixel data
 
 
+def line_sizes(text):
+    """returns the number of whitespace separated values on each line of the text that is not blank
 
-def read_history(history_file):
-    """returns a numpy array containing the data from the history file"""
+    Counted with numpy from the starts of the values, so the rows are checked without splitting each line"""
+    chars = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    value = chars > 32  # not a space, tab, carriage return or newline
+    starts = np.empty(chars.size, dtype=bool)
+    starts[:1] = value[:1]
+    np.greater(value[1:], value[:-1], out=starts[1:])
+    lines = np.flatnonzero(chars == 10) + 1
+    lines = np.concatenate(([0], lines[lines < chars.size]))
+    sizes = np.add.reduceat(starts, lines, dtype=np.int64) if chars.size else np.zeros(0, dtype=np.int64)
+    return sizes[sizes > 0]
+
+
+def opg_plane_position(body):
+    """returns the plane position in mm from the text inside an <asciibody>, None if it has none"""
+    start = body.find('Plane Position:')
+    if start < 0:
+        return None
+    try:
+        return float(body[start + len('Plane Position:'):].split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def read_opg_header(opg_file, file_path):
+    """returns the parsed <asciiheader> of an open opg file, leaving the file at the line after the header"""
+    lines = []
+    for line in opg_file:
+        lines.append(line)
+        if '</asciiheader>' in line:
+            break
+    return parse_opg_header(''.join(lines), file_path)
+
+
+def read_opg_frames(file_path):
+    """yields a frame dictionary for each <asciibody> of an opg file in turn
+
+    The file is read a line at a time and only the body being decoded is held in memory, so files with
+    hundreds of bodies are read in constant memory.  Raises ValueError if a body does not match the header
+    or, once all the bodies are read, if their number is not the header's Number of Bodies"""
+    with open(file_path) as opg_file:
+        header = read_opg_header(opg_file, file_path)
+        count = header['Number of Bodies']
+        index = 0
+        body = None
+        for line in opg_file:
+            if body is None:
+                if '<asciibody>' in line:
+                    body = [line[line.find('<asciibody>') + len('<asciibody>'):]]
+            elif '</asciibody>' in line:
+                body.append(line[:line.find('</asciibody>')])
+                text = ''.join(body)
+                body = None
+                x_axis, y_axis, pixel_data = parse_opg_body(text, header, file_path)
+                if header['Data Factor'] != 1:
+                    pixel_data = pixel_data * header['Data Factor']
+                yield {'index': index, 'count': count, 'plane_position': opg_plane_position(text),
+                       'x_axis': x_axis, 'y_axis': y_axis, 'pixels': compact_pixels(pixel_data)}
+                index += 1
+            else:
+                body.append(line)
+    if index == 0 or body is not None:
+        raise ValueError('format missmatch in opg file ' + file_path + ', no complete <asciibody> section found')
+    if index != count:
+        raise ValueError('format missmatch in opg file ' + file_path + ', ' + str(index) +
+                         ' <asciibody> sections, header Number of Bodies = ' + str(count))
+
+
+def read_dcm_frames(file_path):
+    """yields a frame dictionary for each frame of a dicom file in turn
+
+    With pydicom 3 the frames are decoded one at a time, earlier versions decode the whole pixel array first.
+    The stored pixel values are used without the rescale slope and intercept, the same values dicom2opg writes
+    after run.bat has removed the rescale tags, with the rows flipped to match the opg y axis"""
+    if pydicom is None:
+        raise ValueError('pydicom is required to read dicom file ' + file_path + ', install it or use run.bat')
     try:
-        temp_list = np.load(history_file)
-        kV_history = temp_list.tolist()
-    except FileNotFoundError:
-        kV_history = [
-            '{:<22} {:^40} {:^11} {:^11} {:^11} {:^11} {:^11} {:^11} {:>11} {:>11} {:>11} {:>11}'.format(
-                'Analysis Date','file', 'source','BL', 'BR', 'TL','TR', 'CTR','Dose diff','whole mean',
-                'left mean','right mean')]
-    return kV_history
+        dataset = pydicom.dcmread(file_path, stop_before_pixels=True)
+        count = int(dataset.get('NumberOfFrames', 1) or 1)
+        try:
+            from pydicom.pixels import iter_pixels
+            frames = iter_pixels(file_path)
+        except ImportError:  # pydicom before 3.0
+            pixel_array = pydicom.dcmread(file_path).pixel_array
+            frames = iter(pixel_array if count > 1 else [pixel_array])
+        rows, columns = int(dataset.Rows), int(dataset.Columns)
+    except (pydicom.errors.InvalidDicomError, AttributeError, ValueError) as error:
+        raise ValueError('dicom file ' + file_path + ' could not be read: ' + str(error))
+    spacing = dataset.get('ImagePlanePixelSpacing', dataset.get('PixelSpacing', [1, 1]))
+    position = dataset.get('RTImagePosition', [-(columns - 1) / 2 * float(spacing[1]),
+                                               -(rows - 1) / 2 * float(spacing[0])])
+    frame = {'count': count, 'x_axis': float(position[0]) + float(spacing[1]) * np.arange(columns),
+             'y_axis': float(position[1]) + float(spacing[0]) * np.arange(rows), 'pixel_spacing': float(spacing[1]),
+             'serial_number': str(dataset.get('DeviceSerialNumber', '')) or None,
+             'rescale_slope': float(dataset.get('RescaleSlope', 1)),
+             'rescale_intercept': float(dataset.get('RescaleIntercept', 0))}
+    index = 0
+    while True:
+        try:  # pydicom 3 only decodes each frame as it is taken
+            pixel_data = next(frames, None)
+        except (AttributeError, ValueError, OSError) as error:
+            raise ValueError('dicom file ' + file_path + ' could not be read: ' + str(error))
+        if pixel_data is None:
+            return
+        yield dict(frame, index=index, pixels=compact_pixels(pixel_data[::-1]))
+        index += 1
+
+
+def compact_pixels(pixels):
+    """returns the pixel data as a uint16 array if it holds only whole numbers from 0 to 65535, else unchanged
+
+    The Lynx pixels are 10 bit, so uint16 holds them exactly in a quarter of the memory of float64"""
+    if pixels.dtype == np.uint16 or pixels.size == 0:
+        return pixels
+    if pixels.min() >= 0 and pixels.max() <= 65535:
+        compact = pixels.astype(np.uint16)
+        if pixels.dtype.kind in 'ui' or np.array_equal(compact, pixels):
+            return compact
+    return pixels
+
+
+def image_statistics(pixels):
+    """returns a dictionary of the saturated and zero pixel counts, min, max, mean, background level and noise of
+    an image, all taken from one histogram of its pixel values
+
+    The histogram of uint16 pixels is counted in one pass, pixels of other types are rounded to whole values
+    first.  The background is the most common pixel value other than zero and SATURATION and the noise is the
+    standard deviation of the background peak, from its half width at half maximum"""
+    if pixels.dtype.kind == 'u':
+        offset = 0
+        histogram = np.bincount(pixels.ravel(), minlength=SATURATION + 1)
+    else:
+        values = np.rint(pixels).astype(np.int64).ravel()
+        offset = int(values.min())
+        histogram = np.bincount(values - offset, minlength=max(SATURATION + 1 - offset, 0))
+    levels = np.arange(offset, offset + len(histogram))
+    filled = np.flatnonzero(histogram)
+    zero, saturated = (int(histogram[value - offset]) if 0 <= value - offset < len(histogram) else 0
+                       for value in (0, SATURATION))
+    peak = histogram.copy()
+    peak[np.isin(levels, (0, SATURATION))] = 0
+    background = int(np.argmax(peak))
+    noise = half_width(histogram, background) / np.sqrt(2 * np.log(2)) if peak[background] else 0.0
+    return {'saturated_pixels': saturated, 'zero_pixels': zero, 'min_pixel': float(levels[filled[0]]),
+            'max_pixel': float(levels[filled[-1]]), 'mean_pixel': float(histogram @ levels / pixels.size),
+            'background': float(levels[background]),
+            'noise': float(noise)}
+
+
+def half_width(histogram, peak):
+    """returns the half width at half maximum of the histogram peak at index peak
+
+    Measured on the low side of the peak, where the signal does not add to the background, or on the high side
+    if the low side does not fall to half the height of the peak"""
+    half = histogram[peak] / 2
+    if not half:
+        return 0.0
+    for step in (-1, 1):
+        index = peak
+        while 0 <= index + step < len(histogram) and histogram[index] > half:
+            index += step
+        if histogram[index] <= half:
+            return abs(index - peak) - (half - histogram[index]) / (histogram[index - step] - histogram[index])
+    return 0.0
+
+
+def read_frames(file_path):
+    """yields a frame dictionary for each frame or body of an opg or dicom file, one at a time"""
+    if file_path.lower().endswith('.dcm'):
+        yield from read_dcm_frames(file_path)
+    else:
+        yield from read_opg_frames(file_path)
+
+
+def frame_count(file_path):
+    """returns the number of frames or bodies in an opg or dicom file from its header"""
+    if file_path.lower().endswith('.dcm'):
+        if pydicom is None:
+            return 1  # reported when the file is read
+        try:
+            return int(pydicom.dcmread(file_path, stop_before_pixels=True).get('NumberOfFrames', 1) or 1)
+        except (pydicom.errors.InvalidDicomError, AttributeError, ValueError, OSError):
+            return 1
+    try:
+        with open(file_path) as opg_file:
+            return read_opg_header(opg_file, file_path)['Number of Bodies']
+    except (ValueError, OSError):
+        return 1
+
+
+def image_cache_key(file_path):
+    """returns the cache file name for an image, made from a hash of its contents, its size and modified time and
+    the CACHE_FORMAT"""
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(1024 * 1024), b''):
+            file_hash.update(block)
+    stat = os.stat(file_path)
+    return '{}_{}_{}_v{}'.format(file_hash.hexdigest(), stat.st_size, stat.st_mtime_ns, CACHE_FORMAT)
+
+
+def evict_image_cache(cache_dir, size_limit):
+    """Removes the least recently used images from the cache until it is smaller than size_limit bytes"""
+    entries = []
+    total_size = 0
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npy'):
+            meta_path = entry.path[:-len('.npy')] + '_meta.npz'
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # removed by another run since the folder was listed
+            try:
+                meta_size = os.path.getsize(meta_path)
+            except OSError:
+                meta_size = 0
+            entries.append((stat.st_mtime, entry.path, meta_path, stat.st_size + meta_size))
+            total_size += stat.st_size + meta_size
+    for _, cache_path, meta_path, size in sorted(entries):
+        if total_size <= size_limit:
+            break
+        for path in (cache_path, meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # in use by another run or already removed, it is retried on the next eviction
+        total_size -= size
+
+
+def clear_image_cache(cache_dir):
+    """Deletes all files in the image cache directory"""
+    removed = 0
+    if os.path.isdir(cache_dir):
+        for entry in os.scandir(cache_dir):
+            if entry.is_file():
+                os.remove(entry.path)
+                removed += 1
+    print('Image cache cleared, ' + str(removed) + ' files removed from ' + cache_dir)
+
+
+def analyse_stack(stack, angles, c, protocol=None):
+    """returns the region sums, means, sources and dose differences for every image in an (N, rows, columns) stack
+
+    Gives the same values as read_quadrants(), calculate_means() and calculate_dose_diff() on each image, as a
+    dictionary of length N arrays with the XrayImage attribute names.  If a protocol is given its results for
+    each image are in the roi_results list"""
+    images, rows, columns = stack.shape
+    flipped = np.array([angle == 180 for angle in angles], dtype=bool)
+    top_left = stack[:, 0:100, 0:100].sum(axis=(1, 2))
+    bottom_left = stack[:, rows - 100:rows, 0:100].sum(axis=(1, 2))
+    top_right = stack[:, 0:100, columns - 100:columns].sum(axis=(1, 2))
+    bottom_right = stack[:, rows - 100:rows, columns - 100:columns].sum(axis=(1, 2))
+    r = {'TL': np.where(flipped, top_left, bottom_right),
+         'BL': np.where(flipped, bottom_left, top_right),
+         'TR': np.where(flipped, top_right, bottom_left),
+         'BR': np.where(flipped, bottom_right, top_left),
+         'CTR': stack[:, rows // 4:rows * 3 // 4, columns // 4:columns * 3 // 4].sum(axis=(1, 2)),
+         'whole_mean': stack.mean(axis=(1, 2)),
+         'left_mean': np.empty(images),
+         'right_mean': np.empty(images)}
+    if flipped.any():
+        r['left_mean'][flipped] = stack[flipped][:, :, c[7] - 1:c[8]].mean(axis=(1, 2))
+        r['right_mean'][flipped] = stack[flipped][:, :, c[9] - 1:c[10]].mean(axis=(1, 2))
+    if (~flipped).any():
+        r['left_mean'][~flipped] = stack[~flipped][:, :, columns - c[8]:columns - c[7] + 1].mean(axis=(1, 2))
+        r['right_mean'][~flipped] = stack[~flipped][:, :, columns - c[10]:columns - c[9] + 1].mean(axis=(1, 2))
+    TL, BL, TR, BR = r['TL'], r['BL'], r['TR'], r['BR']
+    sources = [(TL > 500000) & (BR > 500000),
+               (BL > 200000) & (TR < 500000) & (TL < 500000),
+               (BL < 200000) & (TR > 500000) & (500000 > TL),
+               (BL > 200000) & (TR > 500000) & (500000 > TL)]  # same order as calculate_dose_diff()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r['xray_source_1'] = np.select(sources, ['Orthogonal', 'Left_only', 'Right_only', 'Obl_Left'], 'Unknown')
+        r['dose_diff_1'] = np.select(sources, [(r['whole_mean'] - c[2]) / c[2] * 100,
+                                               (r['left_mean'] - c[3]) / c[3] * 100,
+                                               (r['right_mean'] - c[6]) / c[6] * 100,
+                                               (r['left_mean'] - c[3] - c[5]) / (c[3] + c[5]) * 100], 999)
+        r['xray_source_2'] = np.where(sources[3] & ~(sources[0] | sources[1] | sources[2]), 'Obl_Right', 'None')
+        r['dose_diff_2'] = np.where(r['xray_source_2'] == 'Obl_Right',
+                                    (r['right_mean'] - c[4] - c[6]) / (c[4] + c[6]) * 100, 0)
+    statistics = [image_statistics(image) for image in stack]
+    for key in STATISTICS:
+        r[key] = np.array([image[key] for image in statistics])
+    r['roi_results'] = [None if protocol is None else (protocol,) + roi.evaluate(protocol, image) for image in stack]
+    return r
+
+
+def analyse_file(file_name, path, c, cache_dir=None, baselines=None, profile=False, protocol=None):
+    """returns the analysed XrayImage of a file, or the error message if the file could not be read
+
+    If a BaselineRegistry is given the baseline of the image's device is used, else c.  The pixel arrays are
+    released once the image statistics are calculated, so the result is small to return from a worker process.
+    If profile is true the read and analyse stage metrics are kept in xray.metrics, if a protocol in
+    roi.PROTOCOLS is given its regions are evaluated too"""
+    metrics = stage_metrics.StageMetrics(profile)
+    try:
+        with metrics.stage('read', file_name) as record:
+            xray = XrayImage(path + file_name, cache_dir)
+            record['bytes_read'] = xray.bytes_read
+    except ValueError as error:
+        return str(error)
+    analyse_image(xray, file_name, c, baselines, metrics, protocol)
+    xray.metrics = metrics.records
+    return xray
+
+
+def analyse_image(xray, file_name, c, baselines, metrics, protocol=None):
+    """Analyses a loaded XrayImage with the baseline for its device and the protocol regions if a protocol is
+    given, then releases its pixel arrays"""
+    with metrics.stage('analyse', xray.frame_name(file_name)):
+        if baselines is not None:
+            c = baselines.constants(xray.serial_number, default=c)
+        xray.constants = c
+        xray.read_quadrants(c, file_name[-7:-4])
+        xray.calculate_means()
+        xray.calculate_dose_diff(c)
+        xray.calculate_statistics()
+        if protocol is not None:
+            xray.calculate_roi_results(protocol)
+    xray.whole_array = None
+    xray.left_array = None
+    xray.right_array = None
+
+
+def analyse_frames(file_name, path, c, cache_dir=None, baselines=None, profile=False, protocol=None):
+    """returns a list of the analysed XrayImage of each frame of a file, or the error message if the file could
+    not be read
+
+    Files with one image are read by analyse_file(), using the image cache.  The bodies of multi-body opg files
+    and frames of multi-frame dicom files are read, analysed and released one at a time so memory does not grow
+    with the number of frames, they are not cached.  The metrics of all frames are kept in the first frame"""
+    if frame_count(path + file_name) == 1:
+        xray = analyse_file(file_name, path, c, cache_dir, baselines, profile, protocol)
+        return xray if isinstance(xray, str) else [xray]
+    metrics = stage_metrics.StageMetrics(profile)
+    xrays = []
+    frames = read_frames(path + file_name)
+    try:
+        while True:
+            with metrics.stage('read', file_name) as record:
+                frame = next(frames, None)
+                if frame is not None:
+                    xray = XrayImage(None)
+                    xray.load_frame(frame)
+                    record['file'] = xray.frame_name(file_name)
+                    record['bytes_read'] = os.path.getsize(path + file_name) if frame['index'] == 0 else 0
+            if frame is None:
+                break
+            analyse_image(xray, file_name, c, baselines, metrics, protocol)
+            xrays.append(xray)
+    except ValueError as error:
+        return str(error)
+    xrays[0].metrics = metrics.records
+    return xrays
+
+
+def load_pixel_data(file_name, path, cache_dir=None, profile=False):
+    """returns a list of the name, pixel data and device serial number of each frame of a file and the read stage
+    metrics, or the error message if it could not be read"""
+    metrics = stage_metrics.StageMetrics(profile)
+    try:
+        with metrics.stage('read', file_name) as record:
+            if frame_count(path + file_name) == 1:
+                xrays = [XrayImage(path + file_name, cache_dir)]
+                record['bytes_read'] = xrays[0].bytes_read
+            else:
+                xrays = []
+                for frame in read_frames(path + file_name):
+                    xrays.append(XrayImage(None))
+                    xrays[-1].load_frame(frame)
+                record['bytes_read'] = os.path.getsize(path + file_name)
+    except ValueError as error:
+        return str(error)
+    return [(xray.frame_name(file_name), xray.whole_array, xray.serial_number) for xray in xrays], metrics.records
+
+
+def map_files(function, file_list, jobs, **kwargs):
+    """returns an iterator of function(file_name, **kwargs) over the file list in file order
+
+    if jobs is more than 1 the files are processed in a pool of that many processes"""
+    worker = functools.partial(function, **kwargs)
+    if jobs > 1 and len(file_list) > 1:
+        with multiprocessing.Pool(min(jobs, len(file_list))) as pool:
+            yield from pool.imap(worker, file_list, chunksize=4)
+    else:
+        yield from map(worker, file_list)
+
+
+def analyse_batch(path, file_list, c, cache_dir=None, jobs=1, baselines=None, metrics=None, protocol=None):
+    """returns a structured RESULT_DTYPE array of all xray sources found in the files, in file order
+
+    Also returns the index of the image each result came from and a dictionary of the image results, which
+    holds the image statistics, serial numbers, constants used and the errors of files that could not be read.
+    The files are read BATCH_SIZE at a time and their images analysed by analyse_stack(), stacked by image size
+    and baseline, then released before the next files are read, so memory does not grow with the number of
+    files.  Each frame of a multi-frame file is an image named by XrayImage.frame_name().  If jobs is more than
+    1 the files are read in parallel processes, if a StageMetrics is given the reads and stacks are recorded in
+    it.  If a protocol is given the image results also hold the roi_results of each image"""
+    metrics = metrics or stage_metrics.StageMetrics(False)
+    keys = ('BL', 'BR', 'TL', 'TR', 'CTR', 'whole_mean', 'left_mean', 'right_mean', 'xray_source_1',
+            'dose_diff_1', 'xray_source_2', 'dose_diff_2', 'roi_results') + STATISTICS
+    image_results = {key: [] for key in keys}
+    file_names = []
+    serial_numbers = []
+    constants = []
+    errors = []  # (index of the next image, error message) of the files that could not be read
+    for start in range(0, len(file_list), BATCH_SIZE):
+        batch_files = file_list[start:start + BATCH_SIZE]
+        first = len(file_names)  # index of the first image read from these files
+        images = []
+        angles = []
+        for file_name, pixel_data in zip(batch_files, map_files(load_pixel_data, batch_files, jobs, path=path,
+                                                                cache_dir=cache_dir, profile=metrics.enabled)):
+            if isinstance(pixel_data, str):
+                errors.append((len(file_names), pixel_data))
+                continue
+            for name, pixels, serial_number in pixel_data[0]:
+                images.append(pixels)
+                angles.append(file_name[-7:-4])
+                file_names.append(name)
+                serial_numbers.append(serial_number)
+                constants.append(c if baselines is None else baselines.constants(serial_number, default=c))
+            metrics.extend(pixel_data[1])
+        for key in keys:
+            image_results[key] += [None] * len(images)
+        batch_constants = constants[first:]
+        groups = [(image.shape, batch_constants.index(image_constants))
+                  for image, image_constants in zip(images, batch_constants)]
+        for group in sorted(set(groups)):
+            indexes = [i for i, image_group in enumerate(groups) if image_group == group]
+            for stack_start in range(0, len(indexes), BATCH_SIZE):  # multi-frame files can give more images
+                batch = indexes[stack_start:stack_start + BATCH_SIZE]
+                with metrics.stage('analyse_stack', str(len(batch)) + ' images'):
+                    stack = np.stack([images[i] for i in batch])
+                    stack_results = analyse_stack(stack, [angles[i] for i in batch], batch_constants[group[1]],
+                                                  protocol)
+                for key in keys:
+                    for i, value in zip(batch, stack_results[key]):
+                        image_results[key][first + i] = value
+        images = stack = None  # released before the next files are read
+    results = []
+    result_images = []
+    for i, file_name in enumerate(file_names):
+        for source in ('1', '2'):
+            if image_results['xray_source_' + source][i] != 'None':
+                results.append((file_name[:30], image_results['xray_source_' + source][i]) +
+                               tuple(image_results[key][i] for key in ('BL', 'BR', 'TL', 'TR', 'CTR')) +
+                               (image_results['dose_diff_' + source][i],) +
+                               tuple(image_results[key][i] for key in ('whole_mean', 'left_mean', 'right_mean')))
+                result_images.append(i)
+    image_results['file'] = file_names
+    image_results['serial_number'] = serial_numbers
+    image_results['constants'] = constants
+    image_results['errors'] = errors
+    return np.array(results, dtype=RESULT_DTYPE), np.array(result_images, dtype=int), image_results
+
 
 def read_baselines(baseline_value_file):
     """returns an array containing all constants used in the calculations from the baseline file"""
-    c = []
     try:
-        baselines = np.load(baseline_value_file)
-        c.append(baselines[0])  # Baseline date
-        c.append(baselines[1]) # Baseline set by
-        c.append(float(baselines[2]))  # Orthogonal average pixel value, pps x = 0
-        c.append(float(baselines[3]))  # Left obliques average pixel value in left range
-        c.append(float(baselines[4]))  # Left oblique average pixel value in right range
-        c.append(float(baselines[5]))  # Right oblique average pixel value in left range
-        c.append(float(baselines[6]))  # Right oblique average pixel value in right range
-        c.append(int(baselines[7]))  # Start x for left range
-        c.append(int(baselines[8]))  # End x for left range
-        c.append(int(baselines[9]))  # Start x for right range
-        c.append(int(baselines[10]))  # End x for right range        
-        c.append(int(baselines[11])) # Dose tolerance in percent
-    except ValueError:
+        c = baseline_registry.baseline_constants(np.load(baseline_value_file))
+    except (ValueError, OSError):
         print('Baseline file: ' + baseline_value_file + ' could not be loaded.  Script exiting')
         exit(1)
     return c
@@ -186,11 +857,37 @@ def print_heading(data, debug):
     else:
         print(f'{data[0]:^30}\t{data[1]:^9}\t{data[7]:^9}')            
         
-def add_history(data, kV_history):
-    """Adds the current xray image data to the history file"""
-    time = np.datetime_as_string(np.datetime64('now'))
-    new_line = f'{time:<22} {data[0]:<40} {data[1]:<11} {data[2]:>11.1f} {data[3]:>11.1f} {data[4]:>11.1f} {data[5]:>11.1f} {data[6]:>11.1f} {data[7]:>11.1f} {data[8]:>11.1f} {data[9]:>11.1f} {data[10]:>11.1f}'
-    kV_history.append(new_line)
+def add_history(data, kV_history, serial_number, tolerance, statistics=None):
+    """Adds the current xray image data and its image statistics to the list of new history records"""
+    kV_history.append(history_store.history_record(data, serial_number, tolerance, statistics=statistics))
+
+def print_statistics(statistics):
+    """Prints the image statistics of an image under its results"""
+    print(f'{"image statistics":<30} min {statistics["min_pixel"]:.0f}  max {statistics["max_pixel"]:.0f}  '
+          f'mean {statistics["mean_pixel"]:.1f}  background {statistics["background"]:.0f}  '
+          f'noise {statistics["noise"]:.1f}  zero pixels {statistics["zero_pixels"]:.0f}  '
+          f'saturated pixels {statistics["saturated_pixels"]:.0f}')
+
+def print_errors(errors, index):
+    """Prints the errors of the files that could not be read before the image at index in analyse_batch()"""
+    for error_index, error in errors:
+        if error_index == index:
+            print('\n' + error + '\n')
+
+def report_roi_results(roi_results, file_name, serial_number, roi_rows, debug):
+    """Prints the summary values of the protocol regions of an image and adds their rows to the roi_rows list
+
+    if debug is true the mean and standard deviation of every region are printed too"""
+    protocol, stats, summary = roi_results
+    if debug:
+        for region in stats:
+            print(f'{region["name"]:<30} mean {region["mean"]:.1f}  std {np.sqrt(region["variance"]):.1f}')
+    print(f'{protocol:<30} ' + '  '.join(f'{key} {value:.2f}%' for key, value in summary.items()))
+    roi_rows += roi.result_rows(str(np.datetime64('now', 's')), file_name, serial_number, protocol, stats, summary)
+
+def print_saturation(saturated_pixels, file_name):
+    """Prints the saturated pixels warning for an image"""
+    print('\nWarning! {:.0f} saturated pixels in image: {:<22}\n'.format(saturated_pixels, file_name))
 
 def create_file_list(path, extension):
     """returns a file list of all xray image files in the specified path"""
@@ -200,7 +897,7 @@ def create_file_list(path, extension):
             'No measurement files found\n\n'
             'Previous measurements, which the script has already been run on, are in '
             '.\\_old_measurements \nMove back into the .\\Measurements folder '
-            'if you wish to re run the script on them\n')
+            'if you wish to re run the script on them, or use reanalyse.py to re-analyse the whole archive\n')
         exit(1)
     return file_list
 
@@ -227,49 +924,250 @@ def print_max(max_diff, max_diff_source, tolerance):
     elif max_diff > 20 and max_diff_source == 'Obl_Left':
         print('\nCheck that the couch is in the Sphinx treatment position and repeat the oblique measurement\n\n')
 
-def analyse(path, c, kV_history, history_file, debug):
-    """Analyses all xray images in the path specified and prints out the results"""
-    file_list = create_file_list(path, ".opg")
+def report_xray(xray, file_name, kV_history, debug, max_diff, max_diff_source, roi_rows=None):
+    """Prints the results of an analysed xray image and adds them to the kV_history list
+
+    The tolerance is taken from the baseline the image was analysed with, returns the maximum dose difference
+    and its source including this image.  If debug is true the image statistics are printed too, protocol
+    region results are printed and added to the roi_rows list"""
+    c = xray.constants
+    if xray.xray_source_1 != 'None':
+        data = xray.data_string(file_name, 1)
+        print_result(data, debug)
+        add_history(data, kV_history, xray.serial_number, c[11], xray.statistics)
+    if xray.xray_source_2 != 'None':
+        data = xray.data_string(file_name, 2)
+        print_result(data, debug)
+        add_history(data, kV_history, xray.serial_number, c[11], xray.statistics)
+    if debug:
+        print_statistics(xray.statistics)
+    if xray.roi_results is not None:
+        report_roi_results(xray.roi_results, file_name, xray.serial_number, [] if roi_rows is None else roi_rows,
+                           debug)
+    max_diff, max_diff_source = check_max(max_diff, max_diff_source, xray)
+    if xray.saturated_pixels:
+        print_saturation(xray.saturated_pixels, file_name)
+    print_max(max_diff, max_diff_source, c[11])
+    return max_diff, max_diff_source
+
+def analyse(path, c, kV_history, history_file, debug, extension=".opg", cache_dir=None, batch=False, jobs=1,
+            baselines=None, metrics=None, protocol=None):
+    """Analyses all xray images in the path specified and prints out the results
+
+    The results are added to the kV_history list, then appended to the history file and the dose trends
+    if cache_dir is set decoded images are read from and saved to the image cache in that directory
+    if batch is true the images are analysed together by analyse_batch(), giving the same results
+    if jobs is more than 1 the images are read and analysed in that many processes, the results are still
+    printed and added to the history in file order
+    if a BaselineRegistry is given as baselines each image uses the baseline of its device, else c
+    if a StageMetrics is given each stage of the run is recorded in it
+    if a protocol in roi.PROTOCOLS is given its regions are evaluated on each image and saved next to the history"""
+    metrics = metrics or stage_metrics.StageMetrics(False)
+    roi_rows = []
+    with metrics.stage('list_files'):
+        file_list = create_file_list(path, extension)
     data = ('file', 'source', 'BL','BR', 'TL', 'TR', 'CTR','Dose diff','whole mean','left mean','right mean')
     print_heading(data, debug)
     max_diff = 0
     max_diff_source = 'None'
-    for file_name in file_list:
-        file_path = path + file_name
-        xray = XrayImage(file_path)
-        xray.read_quadrants(c, file_name[-7:-4])  
-        xray.calculate_means()          
-        xray.calculate_dose_diff(c)                    
-        if xray.xray_source_1 != 'None':
-            data = xray.data_string(file_name, 1)   
-            print_result(data, debug)
-            add_history(data, kV_history)
-        if xray.xray_source_2 != 'None':
-            data = xray.data_string(file_name, 2)
-            print_result(data, debug)
-            add_history(data, kV_history)
-        max_diff, max_diff_source = check_max(max_diff, max_diff_source, xray)
-        xray.check_saturation(file_name)
-        print_max(max_diff, max_diff_source, c[11])
-    kV_history = np.array(kV_history)
-    np.save(history_file, kV_history)
+    if batch:
+        results, result_images, image_results = analyse_batch(path, file_list, c, cache_dir, jobs, baselines,
+                                                              metrics, protocol)
+        for i, file_name in enumerate(image_results['file']):
+            print_errors(image_results['errors'], i)
+            tolerance = image_results['constants'][i][11]
+            statistics = {key: image_results[key][i] for key in STATISTICS}
+            for data in results[result_images == i]:
+                print_result(data, debug)
+                add_history(data, kV_history, image_results['serial_number'][i], tolerance, statistics)
+                if abs(data['dose_diff']) > abs(max_diff):
+                    max_diff = data['dose_diff']
+                    max_diff_source = data['source']
+            if debug:
+                print_statistics(statistics)
+            if image_results['roi_results'][i] is not None:
+                report_roi_results(image_results['roi_results'][i], file_name, image_results['serial_number'][i],
+                                   roi_rows, debug)
+            if image_results['saturated_pixels'][i]:
+                print_saturation(image_results['saturated_pixels'][i], file_name)
+            print_max(max_diff, max_diff_source, tolerance)
+        print_errors(image_results['errors'], len(image_results['file']))
+    else:
+        for file_name, xrays in zip(file_list, map_files(analyse_frames, file_list, jobs, path=path, c=c,
+                                                         cache_dir=cache_dir, baselines=baselines,
+                                                         profile=metrics.enabled, protocol=protocol)):
+            if isinstance(xrays, str):
+                print('\n' + xrays + '\n')
+                continue
+            for xray in xrays:
+                metrics.extend(xray.metrics)
+                max_diff, max_diff_source = report_xray(xray, xray.frame_name(file_name), kV_history, debug,
+                                                        max_diff, max_diff_source, roi_rows)
+    with metrics.stage('history_append'):
+        history_store.append_history(history_file, kV_history)
+        if roi_rows:
+            roi.append_results(roi.results_file_name(history_file), roi_rows)
+    with metrics.stage('trend_update'):
+        warnings = dose_trend.update_trends(history_file, kV_history, c, baselines)
+    for warning in warnings:
+        print('\n' + warning)
+
+
+def ready_files(path, extension, pending, analysed):
+    """returns the new files in the path that have finished being written
+
+    pending holds the size, modified time and time first seen of files still being written and analysed the
+    files already returned, a file is ready once it is unchanged for WATCH_SETTLE_TIME and can be opened"""
+    ready = []
+    now = time.time()
+    for entry in os.scandir(path):
+        if not entry.name.endswith(extension):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue  # moved or deleted since the path was listed
+        signature = (entry.name, stat.st_size, stat.st_mtime_ns)
+        if signature in analysed:
+            continue
+        if pending.get(entry.name, (None,))[0] != signature:
+            pending[entry.name] = (signature, now)
+        elif now - pending[entry.name][1] >= WATCH_SETTLE_TIME:
+            try:
+                with open(entry.path, 'rb'):
+                    pass
+            except OSError:
+                continue  # still open in the program saving it
+            ready.append(entry.name)
+            analysed.add(signature)
+            del pending[entry.name]
+    return sorted(ready)
+
+
+def watch(path, c, history_file, results_file, debug, extension=".opg", cache_dir=None, baselines=None,
+          metrics=None, protocol=None):
+    """Watches the path and analyses each new xray image as soon as it has been saved, until Ctrl+C is pressed
+
+    The results of each file are printed, appended to the history file and the dose trends and written to
+    the end of the results file, if a StageMetrics is given the stages of each file are recorded in it and if
+    a protocol is given its region results are saved next to the history, a file that cannot be analysed or
+    saved is reported and the watching carries on"""
+    metrics = metrics or stage_metrics.StageMetrics(False)
+    print('Watching ' + path + ' for new ' + extension + ' files, press Ctrl+C to stop\n')
+    data = ('file', 'source', 'BL','BR', 'TL', 'TR', 'CTR','Dose diff','whole mean','left mean','right mean')
+    pending = {}
+    analysed = set()
+    try:
+        while True:
+            try:
+                file_names = ready_files(path, extension, pending, analysed)
+            except OSError as error:
+                print('\nCould not list ' + path + ': ' + str(error) + '\n')
+                file_names = []
+            for file_name in file_names:
+                try:
+                    xrays = analyse_frames(file_name, path, c, cache_dir, baselines, metrics.enabled, protocol)
+                    if isinstance(xrays, str):
+                        print('\n' + xrays + '\n')
+                        continue
+                    kV_history = []
+                    roi_rows = []
+                    print_heading(data, debug)
+                    max_diff, max_diff_source = 0, 'None'
+                    for xray in xrays:
+                        metrics.extend(xray.metrics)
+                        max_diff, max_diff_source = report_xray(xray, xray.frame_name(file_name), kV_history, debug,
+                                                                max_diff, max_diff_source, roi_rows)
+                    with metrics.stage('history_append', file_name):
+                        history_store.append_history(history_file, kV_history)
+                        if roi_rows:
+                            roi.append_results(roi.results_file_name(history_file), roi_rows)
+                    with metrics.stage('trend_update', file_name):
+                        warnings = dose_trend.update_trends(history_file, kV_history, c, baselines)
+                    for warning in warnings:
+                        print('\n' + warning)
+                    with open(results_file, 'a') as results:
+                        for record in kV_history:
+                            results.write('{} {:<30} {:<11} {:>9.1f} {}\n'.format(record[0], record[1], record[2],
+                                                                                    record[8], record[13]))
+                except Exception as error:  # e.g. the history lock timing out, the watcher keeps running
+                    print('\n' + file_name + ' could not be processed: ' + str(error) + '\n')
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        print('Stopped watching ' + path)
 
 
 def main():
     """Calls analyse() with the path, baseline file and history file specifed below
     
-    -d as an argument sets debug to true.  Debugging data is then printed to the terminal at runtime"""
+    -d as an argument sets debug to true.  Debugging data is then printed to the terminal at runtime
+    -n as an argument analyses the .dcm files in the path instead of the .opg files
+    -c as an argument clears the image cache and exits
+    -b as an argument analyses the images in batches with analyse_batch()
+    --jobs N as arguments reads and analyses the images in N parallel processes
+    -w as an argument calls watch() instead, analysing new files as they are saved until Ctrl+C is pressed
+    -p as an argument records the metrics of each stage of the run, prints a summary and saves them
+    --protocol NAME as arguments evaluates the regions of the roi.py protocol on each image and saves them"""
     path = '.\\Measurements\\'  # Directory with opg files in it
     # Baseline values stored in this file (NP10 = SN67053, NE22 = SN68212, RG2 = SN68246, NE22 loan ID = ID19260936)
+    # used for images without a device serial number, e.g. opg files
     baseline_value_file = '.\\bin\\baseline_SN68246.npy'
-    history_file = '.\\bin\\history.npy'  # History stored in this file
+    baseline_dir = '.\\bin\\'  # Baselines of all devices, chosen by the device serial number of each image
+    history_file = '.\\bin\\history.dat'  # History stored in this file
+    legacy_history_file = '.\\bin\\history.npy'  # History before v3.7, migrated to history_file on the first run
+    cache_dir = '.\\bin\\image_cache\\'  # Decoded images are cached in this directory
+    results_file = '.\\output.txt'  # Results are added to this file in watch mode
+    metrics_file = '.\\bin\\metrics.jsonl'  # Stage metrics are added to this file with -p
     debug = False
-    for a in sys.argv:
+    extension = '.opg'
+    batch = False
+    jobs = 1
+    watch_mode = False
+    profile = False
+    protocol = None
+    for i, a in enumerate(sys.argv):
         if a == '-d':
-            debug = True            
-    kV_history = read_history(history_file)
-    constants = read_baselines(baseline_value_file)
-    analyse(path, constants, kV_history, history_file, debug)
+            debug = True
+        elif a == '-n':
+            extension = '.dcm'
+        elif a == '-b':
+            batch = True
+        elif a == '-w':
+            watch_mode = True
+        elif a == '-p':
+            profile = True
+        elif a == '--protocol':
+            protocol = sys.argv[i + 1] if i + 1 < len(sys.argv) else None
+            if protocol not in roi.PROTOCOLS:
+                print('--protocol must be followed by one of: ' + ', '.join(roi.PROTOCOLS))
+                exit(1)
+        elif a == '--jobs':
+            try:
+                jobs = max(1, int(sys.argv[i + 1]))
+            except (IndexError, ValueError):
+                print('--jobs must be followed by the number of processes, e.g. --jobs 4')
+                exit(1)
+        elif a == '-c':
+            clear_image_cache(cache_dir)
+            return
+    if not os.path.exists(history_file) and os.path.exists(legacy_history_file):
+        history_store.migrate_npy_history(legacy_history_file, history_file)
+    kV_history = []
+    metrics = stage_metrics.StageMetrics(profile)
+    with metrics.stage('load_baselines'):
+        constants = read_baselines(baseline_value_file)
+        baselines = baseline_registry.BaselineRegistry(baseline_dir)
+    if dose_trend.needs_rebuild(history_file):
+        dose_trend.rebuild_trends(history_file, constants, baselines)
+    if watch_mode:
+        watch(path, constants, history_file, results_file, debug, extension, cache_dir, baselines, metrics,
+              protocol)
+    else:
+        analyse(path, constants, kV_history, history_file, debug, extension, cache_dir, batch, jobs, baselines,
+                metrics, protocol)
+    if profile:
+        metrics.print_summary()
+        metrics.save(metrics_file)
     
     
 if __name__ == "__main__":
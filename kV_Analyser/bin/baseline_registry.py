@@ -0,0 +1,164 @@
+"""Registry of the kV dose baselines of every Lynx device
+
+All baseline sets in the baseline directory are loaded once: the baseline_SN*.npy and baseline_ID*.npy
+files, the baseline_NE/SW/TV.txt printouts, previous_baseline.npy and the older versions archived by
+setBaseline.py in baseline_versions.  Sets with the same device serial (0018,1000) are versions of the
+baseline for that device, ordered by baseline date.  analyse_kV_dose.py uses the registry to pick the
+baseline of each image from its device serial.
+
+Usage:
+          python baseline_registry.py [baseline directory]
+          lists the devices and baseline versions found
+
+Baseline array layout:
+          0 date, 1 set by, 2-6 average pixel values, 7-10 left and right ranges,
+          11 device serial number (12 values, as written by setBaseline.py before 2026) or
+          11 dose tolerance in percent and 12 device serial number (13 values)
+
+18.10.26 first version"""
+
+import sys, os, datetime
+import numpy as np
+
+
+DEFAULT_TOLERANCE = 10  # dose tolerance in percent when the baseline file does not hold one
+VERSIONS_DIR = 'baseline_versions'  # sub directory setBaseline.py archives replaced baselines in
+
+
+def baseline_constants(baselines):
+    """returns the list of constants used in the calculations from the values of a baseline set
+
+    c[11] is the dose tolerance and c[12] the device serial number, '' if the set does not hold one"""
+    if len(baselines) < 11:
+        raise ValueError('baseline set has ' + str(len(baselines)) + ' values, at least 11 are needed')
+    c = []
+    c.append(str(baselines[0]))  # Baseline date
+    c.append(str(baselines[1]))  # Baseline set by
+    c.append(float(baselines[2]))  # Orthogonal average pixel value, pps x = 0
+    c.append(float(baselines[3]))  # Left obliques average pixel value in left range
+    c.append(float(baselines[4]))  # Left oblique average pixel value in right range
+    c.append(float(baselines[5]))  # Right oblique average pixel value in left range
+    c.append(float(baselines[6]))  # Right oblique average pixel value in right range
+    c.append(int(baselines[7]))  # Start x for left range
+    c.append(int(baselines[8]))  # End x for left range
+    c.append(int(baselines[9]))  # Start x for right range
+    c.append(int(baselines[10]))  # End x for right range
+    if len(baselines) >= 13:
+        c.append(float(baselines[11]))  # Dose tolerance in percent
+        c.append(str(baselines[12]))  # Device serial number
+    else:
+        c.append(DEFAULT_TOLERANCE)
+        c.append(str(baselines[11]) if len(baselines) == 12 else '')
+    return c
+
+
+def load_baseline_file(file_path):
+    """returns the values of a baseline .npy file or a baseline .txt printout with one value per line"""
+    if file_path.endswith('.txt'):
+        with open(file_path) as baseline_file:
+            return [line.strip() for line in baseline_file if line.strip()]
+    return np.load(file_path).tolist()
+
+
+def baseline_date(c):
+    """returns the baseline date of a set of constants as a datetime, dates are entered as dd/mm/yyyy"""
+    try:
+        return datetime.datetime.strptime(c[0], '%d/%m/%Y')
+    except ValueError:
+        return datetime.datetime.min
+
+
+class BaselineRegistry:
+    """Holds every baseline version found in the baseline directory, keyed by device serial number"""
+    def __init__(self, baseline_dir):
+        self.baseline_dir = baseline_dir
+        self.devices = {}  # device serial, or file key for sets without one, to a list of versions oldest first
+        self.aliases = {}  # file keys e.g. SN68246, ID18066528 or TV to the device they belong to
+        self.load()
+
+    def load(self):
+        """Reads all baseline files in the baseline directory and the archived versions"""
+        files = [(f, os.path.join(self.baseline_dir, f)) for f in os.listdir(self.baseline_dir)]
+        versions_dir = os.path.join(self.baseline_dir, VERSIONS_DIR)
+        if os.path.isdir(versions_dir):
+            files += [(f, os.path.join(versions_dir, f)) for f in os.listdir(versions_dir)]
+        for file_name, file_path in files:
+            stem, extension = os.path.splitext(file_name)
+            if extension not in ('.npy', '.txt') or not (stem.startswith('baseline') or
+                                                         stem.startswith('previous_baseline')):
+                continue
+            try:
+                c = baseline_constants(load_baseline_file(file_path))
+            except (ValueError, OSError) as error:
+                print('Baseline file: ' + file_path + ' could not be loaded, ' + str(error))
+                continue
+            self.add(stem, file_path, c)
+        for versions in self.devices.values():
+            versions.sort(key=lambda v: (baseline_date(v['constants']), v['rank'], v['name']))
+
+    def add(self, stem, file_path, c):
+        """Adds a baseline set to the versions of its device, identical sets are only kept once"""
+        key = stem.split('_')[1] if stem.startswith('baseline_') else ''
+        device = c[12] or (key[2:] if key.startswith('ID') else key) or stem
+        if key:
+            self.aliases[key] = device
+        versions = self.devices.setdefault(device, [])
+        for version in versions:
+            if version['constants'] == c:
+                return
+        # replaced sets sort before the current set when they have the same baseline date
+        rank = 0 if VERSIONS_DIR in file_path or stem.startswith('previous') else 1
+        versions.append({'name': os.path.basename(file_path), 'file': file_path, 'constants': c, 'rank': rank})
+
+    def device(self, serial):
+        """returns the device key for a serial number or file key, None if there is no baseline for it"""
+        if serial is None:
+            return None
+        serial = str(serial)
+        for key in (serial, 'ID' + serial, 'SN' + serial):
+            if key in self.devices:
+                return key
+            if key in self.aliases:
+                return self.aliases[key]
+        return None
+
+    def versions(self, serial):
+        """returns the baseline versions of a device, oldest first"""
+        device = self.device(serial)
+        return self.devices[device] if device is not None else []
+
+    def constants(self, serial, version=None, default=None):
+        """returns the constants of the baseline for a device serial number
+
+        version selects an older baseline, either an index into versions() or a baseline date dd/mm/yyyy,
+        by default the latest.  default is returned if the registry has no baseline for the device"""
+        versions = self.versions(serial)
+        if not versions:
+            return default
+        if version is None:
+            return versions[-1]['constants']
+        if isinstance(version, int):
+            return versions[version]['constants']
+        dated = [v for v in versions if v['constants'][0] == version]
+        if not dated:
+            raise ValueError('no baseline dated ' + str(version) + ' for device ' + str(serial))
+        return dated[-1]['constants']
+
+    def constants_on(self, serial, date, default=None):
+        """returns the constants of the baseline in use on a date dd/mm/yyyy for a device serial number
+
+        This is the latest version dated on or before the date, default is returned if the device had no
+        baseline by then"""
+        date = datetime.datetime.strptime(date, '%d/%m/%Y')
+        dated = [v for v in self.versions(serial) if baseline_date(v['constants']) <= date]
+        return dated[-1]['constants'] if dated else default
+
+
+if __name__ == "__main__":
+    registry = BaselineRegistry(sys.argv[1] if len(sys.argv) > 1 else '.')
+    for device, versions in sorted(registry.devices.items()):
+        names = [key for key, value in registry.aliases.items() if value == device]
+        print(device + ' (' + ', '.join(sorted(names)) + ')')
+        for i, version in enumerate(versions):
+            c = version['constants']
+            print('    {} {:<10} {:<4} {}  tolerance {}%'.format(i, c[0], c[1], version['name'], c[11]))
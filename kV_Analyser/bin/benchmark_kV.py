@@ -0,0 +1,182 @@
+"""Benchmarks of the kV dose analysis on synthetic Lynx images
+
+Times reading opg and dicom files, analysing single images of each pattern and size, whole runs of
+analyse() on folders of 10 to 10,000 files with and without batch mode, and appending to and reading the
+history store.  Each benchmark is repeated and the fastest and median times are saved as json with the
+python, numpy and machine details, so results can be compared between releases.
+
+Usage:
+          python benchmark_kV.py [options]
+Options:
+          --files 10,100,1000      numbers of files in the analyse() runs, up to 10000
+          --sizes 600,1200         image sizes in pixels, rows = columns
+          --repeat N               times each benchmark is run, 3 by default
+          --output FILE            json file the results are saved in, benchmark_results.json in the work
+                                   folder if given, otherwise next to this script
+          --compare FILE           prints the change from an earlier results file
+          --work-dir DIR           folder for the synthetic images, a temporary folder by default
+
+18.10.26 first version"""
+
+import os, time, json, argparse, platform, tempfile, shutil, contextlib, statistics
+import numpy as np
+import analyse_kV_dose
+import history_store
+import baseline_registry
+import synthetic_images
+
+UNIQUE_IMAGES = 20  # different images generated for each run of analyse(), the other files link to them
+HISTORY_ROWS = (1000, 100000)  # rows already in the history store when appending
+
+
+def time_function(function, repeat, setup=None):
+    """returns the fastest and median wall times in seconds of repeat calls of function
+
+    if setup is given it is called untimed before each call and its value passed to function"""
+    times = []
+    for _ in range(repeat):
+        arguments = (setup(),) if setup else ()
+        start = time.perf_counter()
+        function(*arguments)
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def result(name, params, times, items=1, size_bytes=None):
+    """returns the dictionary saved for one benchmark"""
+    fastest, median = times
+    entry = {'benchmark': name, 'params': params, 'min_seconds': fastest, 'median_seconds': median,
+             'per_item_ms': fastest / items * 1000}
+    if size_bytes:
+        entry['mb_per_second'] = size_bytes / fastest / 1e6 if fastest else None
+    return entry
+
+
+def benchmark_reading(work_dir, sizes, repeat, c):
+    """returns the reading and single image analysis benchmarks for each pattern, size and file type"""
+    results = []
+    extensions = ['.opg'] + (['.dcm'] if synthetic_images.pydicom is not None else [])
+    for size in sizes:
+        for extension in extensions:
+            folder = os.path.join(work_dir, 'images_{}{}'.format(size, extension.replace('.', '_')))
+            file_names = synthetic_images.write_images(folder, len(synthetic_images.PATTERNS), size, size, extension)
+            file_names.append('Synthetic_saturated_00000_000' + extension)
+            synthetic_images.write_image(os.path.join(folder, file_names[-1]),
+                                         synthetic_images.make_image('dual', size, size, saturated=20))
+            path = folder + os.sep
+            for file_name in file_names:
+                params = {'pattern': file_name.split('_')[1], 'rows': size, 'columns': size, 'format': extension[1:]}
+                size_bytes = os.path.getsize(path + file_name)
+                results.append(result('read', params, time_function(
+                    lambda: analyse_kV_dose.XrayImage(path + file_name), repeat), size_bytes=size_bytes))
+                results.append(result('analyse_image', params, time_function(
+                    lambda: analyse_kV_dose.analyse_file(file_name, path, c), repeat), size_bytes=size_bytes))
+    return results
+
+
+def benchmark_runs(work_dir, file_counts, repeat, c, registry):
+    """returns the benchmarks of whole analyse() runs on folders of synthetic opg files
+
+    each run starts with an empty history in its own temporary folder, so the runs time the same work"""
+    results = []
+    history_dir = os.path.join(work_dir, 'run_histories')
+    for count in file_counts:
+        folder = os.path.join(work_dir, 'run_{}'.format(count))
+        synthetic_images.write_images(folder, count, unique=UNIQUE_IMAGES, saturated_every=10)
+        size_bytes = sum(entry.stat().st_size for entry in os.scandir(folder))
+        os.makedirs(history_dir, exist_ok=True)
+        for batch in (False, True):
+
+            def new_history():
+                return os.path.join(tempfile.mkdtemp(dir=history_dir), 'run_history.dat')
+
+            def run(history_file):
+                with open(os.devnull, 'w') as output, contextlib.redirect_stdout(output):
+                    analyse_kV_dose.analyse(folder + os.sep, c, [], history_file, True, batch=batch,
+                                            baselines=registry)
+            results.append(result('analyse_run', {'files': count, 'batch': batch},
+                                  time_function(run, repeat, new_history), count, size_bytes))
+        shutil.rmtree(folder)
+        shutil.rmtree(history_dir)
+    return results
+
+
+def benchmark_history(work_dir, repeat):
+    """returns the benchmarks of appending a daily run to, and reading, history stores of different lengths"""
+    results = []
+    data = ('Synthetic_dual_00003_000.opg', 'Obl_Left', 730433.0, 133458.0, 31443.0, 4387735.0, 32093899.0,
+            -2.3, 222.5, 52.8, 276.4)
+    daily = [history_store.history_record(data, '18066528', 10)] * 3
+    for rows in HISTORY_ROWS:
+        history_file = os.path.join(work_dir, 'history_{}.dat'.format(rows))
+        if os.path.exists(history_file):
+            os.remove(history_file)
+        history_store.append_history(history_file, [daily[0]] * rows)
+        results.append(result('history_append', {'rows': rows, 'new_rows': len(daily)},
+                              time_function(lambda: history_store.append_history(history_file, daily), repeat)))
+        results.append(result('history_read', {'rows': rows}, time_function(
+            lambda: np.asarray(history_store.read_history(history_file))['dose_diff'].mean(), repeat), rows))
+    return results
+
+
+def benchmark_key(entry):
+    """returns a key identifying a benchmark and its parameters"""
+    return entry['benchmark'] + ' ' + ' '.join('{}={}'.format(k, v) for k, v in sorted(entry['params'].items()))
+
+
+def print_results(results, previous=None):
+    """Prints a table of the results and the change from the previous results if given"""
+    previous = {benchmark_key(entry): entry for entry in (previous or [])}
+    print(f'{"benchmark":<68} {"min s":>10} {"median s":>10} {"ms/item":>10} {"change":>8}')
+    for entry in results:
+        key = benchmark_key(entry)
+        change = ''
+        if key in previous and previous[key]['min_seconds']:
+            change = '{:+.0f}%'.format((entry['min_seconds'] / previous[key]['min_seconds'] - 1) * 100)
+        print(f'{key:<68} {entry["min_seconds"]:>10.4f} {entry["median_seconds"]:>10.4f} '
+              f'{entry["per_item_ms"]:>10.2f} {change:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the kV dose analysis on synthetic images')
+    parser.add_argument('--files', default='10,100,1000')
+    parser.add_argument('--sizes', default='600,1200')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--work-dir')
+    args = parser.parse_args()
+    try:
+        file_counts = [int(n) for n in args.files.split(',')]
+        sizes = [int(n) for n in args.sizes.split(',')]
+    except ValueError:
+        print('--files and --sizes must be comma separated numbers, e.g. --files 10,100,1000')
+        exit(1)
+    bin_dir = os.path.dirname(os.path.abspath(__file__))
+    c = analyse_kV_dose.read_baselines(os.path.join(bin_dir, 'baseline_SN68246.npy'))
+    registry = baseline_registry.BaselineRegistry(bin_dir)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='kV_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = benchmark_reading(work_dir, sizes, args.repeat, c)
+        results += benchmark_runs(work_dir, file_counts, args.repeat, c, registry)
+        results += benchmark_history(work_dir, args.repeat)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    output_file = args.output or os.path.join(args.work_dir or bin_dir, 'benchmark_results.json')
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)['results']
+    print_results(results, previous)
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+              'cpu_count': os.cpu_count(), 'repeat': args.repeat, 'results': results}
+    with open(output_file, 'w') as output:
+        json.dump(report, output, indent=1)
+    print('\nResults saved in ' + output_file)
+
+
+if __name__ == "__main__":
+    main()
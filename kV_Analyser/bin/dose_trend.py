@@ -0,0 +1,160 @@
+"""Rolling dose difference statistics per xray source and device for drift detection
+
+For each source and device serial the number of results, mean and standard deviation (Welford), an
+exponentially weighted moving average and upper and lower CUSUM sums of the dose difference are kept in a
+small json file next to the history.  They are updated with each new result only, so the daily run does
+not depend on the length of the history.  A drift warning is given when the EWMA passes
+EWMA_LIMIT_FRACTION of the tolerance or a CUSUM sum passes CUSUM_LIMIT, before a single result is out of
+tolerance.  Each result is compared to the tolerance of the baseline it was scored against, results out of
+tolerance are already reported as a Fail and are left out of the statistics.  The statistics of a source
+and device start again when its baseline is replaced.
+
+Usage:
+          python dose_trend.py history.dat [baseline directory]
+          rebuilds the trend statistics from the whole history store, e.g. after migrating history.npy, using
+          the baselines in the baseline directory, .\\bin\\ by default
+
+18.10.26 first version
+18.10.26 Fail results left out, statistics restarted for a new baseline, tolerance of each result's baseline"""
+
+import sys, os, json, math, datetime
+import numpy as np
+import history_store
+import baseline_registry
+
+
+EWMA_WEIGHT = 0.2  # weight of the newest result in the exponentially weighted moving average
+EWMA_LIMIT_FRACTION = 0.5  # drift warning when the EWMA is more than this fraction of the tolerance
+CUSUM_SLACK = 2.0  # dose difference in percent allowed each day before the CUSUM sums accumulate
+CUSUM_LIMIT = 10.0  # drift warning when a CUSUM sum is above this, in percent
+MINIMUM_RESULTS = 3  # results needed for a source and device before drift warnings are given
+
+
+def trend_file_name(history_file):
+    """returns the file name of the trend statistics for a history file"""
+    return history_file + '.trend.json'
+
+
+def new_statistics(baseline):
+    """returns the empty statistics of a source and device scored against the baseline dated baseline"""
+    return {'count': 0, 'mean': 0.0, 'm2': 0.0, 'std': 0.0, 'ewma': 0.0, 'cusum_high': 0.0, 'cusum_low': 0.0,
+            'last_date': '', 'baseline': baseline}
+
+
+def read_trends(trend_file):
+    """returns the dictionary of statistics for each source and device, empty if there is no trend file"""
+    try:
+        with open(trend_file) as trends:
+            return json.load(trends)
+    except FileNotFoundError:
+        return {}
+
+
+def save_trends(trend_file, trends):
+    """Saves the trend statistics, replacing the file in one step"""
+    with open(trend_file + '.tmp', 'w') as trend:
+        json.dump(trends, trend, indent=1)
+    os.replace(trend_file + '.tmp', trend_file)
+
+
+def update_statistics(stats, dose_diff, analysis_date):
+    """Adds one dose difference to the running statistics of a source and device"""
+    stats['count'] += 1
+    delta = dose_diff - stats['mean']
+    stats['mean'] += delta / stats['count']
+    stats['m2'] += delta * (dose_diff - stats['mean'])
+    stats['std'] = math.sqrt(stats['m2'] / (stats['count'] - 1)) if stats['count'] > 1 else 0.0
+    stats['ewma'] = dose_diff if stats['count'] == 1 else EWMA_WEIGHT * dose_diff + (1 - EWMA_WEIGHT) * stats['ewma']
+    stats['cusum_high'] = max(0.0, stats['cusum_high'] + dose_diff - CUSUM_SLACK)
+    stats['cusum_low'] = min(0.0, stats['cusum_low'] + dose_diff + CUSUM_SLACK)
+    stats['last_date'] = analysis_date
+
+
+def drift_message(key, stats, tolerance):
+    """returns a warning if the statistics show a drift in the dose difference, otherwise None"""
+    if stats['count'] < MINIMUM_RESULTS:
+        return None
+    reasons = []
+    if abs(stats['ewma']) > EWMA_LIMIT_FRACTION * tolerance:
+        reasons.append('EWMA {:.1f}%'.format(stats['ewma']))
+    if stats['cusum_high'] > CUSUM_LIMIT or stats['cusum_low'] < -CUSUM_LIMIT:
+        reasons.append('CUSUM {:.1f}% / {:.1f}%'.format(stats['cusum_high'], stats['cusum_low']))
+    if not reasons:
+        return None
+    return 'Warning! Dose drift for ' + key + ': ' + ', '.join(reasons) + ' over ' + str(stats['count']) + ' results'
+
+
+def trend_key(record):
+    """returns the statistics key of a history record, the source and device serial"""
+    return str(record['source']) + ' ' + (str(record['serial']) or 'unknown device')
+
+
+def record_baseline(record, c=None, baselines=None):
+    """returns the tolerance and baseline date of the baseline a history record was scored against
+
+    This is the baseline of its device in use on the analysis date if a BaselineRegistry is given and has one,
+    else c, or DEFAULT_TOLERANCE and no date if c is None too"""
+    if baselines is not None and not np.isnat(record['analysis_date']):
+        date = record['analysis_date'].astype(datetime.datetime).strftime('%d/%m/%Y')
+        c = baselines.constants_on(str(record['serial']) or None, date, default=c)
+    if c is None:
+        return history_store.DEFAULT_TOLERANCE, ''
+    return float(c[11]), str(c[0])
+
+
+def add_records(trends, records, c=None, baselines=None):
+    """Updates the statistics with the history records and returns the drift warnings for the updated keys
+
+    Results with an unknown source or out of the tolerance of their baseline are left out, the statistics of a
+    key are restarted when its baseline date changes"""
+    updated = {}
+    for record in records:
+        tolerance, baseline = record_baseline(record, c, baselines)
+        if record['status'] == 'Unknown' or abs(record['dose_diff']) > tolerance:
+            continue
+        key = trend_key(record)
+        stats = trends.setdefault(key, new_statistics(baseline))
+        if stats.setdefault('baseline', baseline) != baseline:
+            stats = trends[key] = new_statistics(baseline)
+        update_statistics(stats, float(record['dose_diff']), str(record['analysis_date']))
+        updated[key] = tolerance
+    return [m for m in (drift_message(key, trends[key], tolerance) for key, tolerance in updated.items()) if m]
+
+
+def update_trends(history_file, records, c=None, baselines=None):
+    """Updates the trend file of the history with the new history records, returns any drift warnings
+
+    Each record is scored against the baseline of its device in baselines, or c, see record_baseline()"""
+    trend_file = trend_file_name(history_file)
+    records = np.array(records, dtype=history_store.HISTORY_DTYPE)
+    with history_store.history_lock(trend_file):
+        trends = read_trends(trend_file)
+        warnings = add_records(trends, records, c, baselines)
+        save_trends(trend_file, trends)
+    return warnings
+
+
+def needs_rebuild(history_file):
+    """returns True if the history has no trend file, or one saved before the baseline of each key was kept"""
+    trends = read_trends(trend_file_name(history_file))
+    return not trends or any('baseline' not in stats for stats in trends.values())
+
+
+def rebuild_trends(history_file, c=None, baselines=None):
+    """Recalculates the trend statistics from the whole history store"""
+    trend_file = trend_file_name(history_file)
+    trends = {}
+    warnings = add_records(trends, history_store.read_history(history_file), c, baselines)
+    with history_store.history_lock(trend_file):
+        save_trends(trend_file, trends)
+    return warnings
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print('Invalid input arguments, example usage: python dose_trend.py history.dat [baseline directory]')
+        exit(1)
+    registry = baseline_registry.BaselineRegistry(sys.argv[2] if len(sys.argv) == 3 else '.\\bin\\')
+    for warning in rebuild_trends(sys.argv[1], baselines=registry):
+        print(warning)
+    print('Trend statistics saved in ' + trend_file_name(sys.argv[1]))
@@ -0,0 +1,212 @@
+"""Append-only store for the kV dose analysis history
+
+The history file starts with a fixed size text header holding the column types, followed by one fixed size
+binary record per result.  New results are appended without rewriting the file, under a lock file so two
+workstations writing to the shared drive do not lose each other's rows.  The records are read back as a
+numpy structured array with typed columns.
+
+Usage:
+          python history_store.py history.npy history.dat
+          migrates an old history.npy file of formatted strings into the history store
+
+18.10.26 first version, replaces the history.npy array of strings
+18.10.26 image statistics columns added, older stores are upgraded on the next append"""
+
+import sys, os, time, json, contextlib
+import numpy as np
+
+
+HEADER_SIZE = 1024  # bytes reserved for the header at the start of the history file
+HEADER_TAG = 'kV history store'
+LOCK_TIMEOUT = 60  # seconds to wait for another run to release the history file
+STALE_LOCK_AGE = 30  # seconds after which a lock file left by a crashed run is removed, less than LOCK_TIMEOUT
+DEFAULT_TOLERANCE = 10  # dose tolerance in percent used to score migrated rows
+HISTORY_DTYPE = np.dtype([('analysis_date', 'datetime64[s]'), ('file', 'U40'), ('source', 'U11'),
+                          ('BL', float), ('BR', float), ('TL', float), ('TR', float), ('CTR', float),
+                          ('dose_diff', float), ('whole_mean', float), ('left_mean', float),
+                          ('right_mean', float), ('serial', 'U16'), ('status', 'U7'),
+                          ('saturated_pixels', np.int64), ('zero_pixels', np.int64), ('min_pixel', float),
+                          ('max_pixel', float), ('background', float), ('noise', float)])
+STATISTICS_FIELDS = HISTORY_DTYPE.names[-6:]  # columns filled from the image statistics of analyse_kV_dose.py
+MISSING_COUNT = -1  # saturated_pixels and zero_pixels of a record without image statistics, the others are NaN
+
+
+def tolerance_status(source, dose_diff, tolerance):
+    """returns Pass, Fail or Unknown for a dose difference compared to the tolerance"""
+    if source == 'Unknown' or dose_diff == 999:
+        return 'Unknown'
+    return 'Pass' if abs(dose_diff) <= tolerance else 'Fail'
+
+
+def missing_statistic(name):
+    """returns the value of a statistics column left empty, MISSING_COUNT for the pixel counts and NaN otherwise"""
+    return MISSING_COUNT if HISTORY_DTYPE[name].kind == 'i' else np.nan
+
+
+def history_record(data, serial, tolerance, analysis_date=None, statistics=None):
+    """returns a HISTORY_DTYPE record tuple from the data list returned by XrayImage.data_string()
+
+    statistics is the dictionary of image statistics of the image, the statistics columns are left empty
+    without it, see missing_statistic()"""
+    if analysis_date is None:
+        analysis_date = np.datetime64('now', 's')
+    statistics = statistics or {}
+    data = tuple(data)
+    return ((analysis_date, str(data[0])[:40], str(data[1])) + tuple(float(v) for v in data[2:11]) +
+            (serial or '', tolerance_status(data[1], data[7], tolerance)) +
+            tuple(statistics.get(name, missing_statistic(name)) for name in STATISTICS_FIELDS))
+
+
+def read_header(history_file):
+    """returns the dtype stored in the header of the history file, None if the file does not exist"""
+    try:
+        with open(history_file, 'rb') as store:
+            header = store.read(HEADER_SIZE).decode('ascii').rstrip()
+    except FileNotFoundError:
+        return None
+    tag, _, descr = header.partition('\n')
+    if tag != HEADER_TAG:
+        raise ValueError(history_file + ' is not a kV history store')
+    return np.dtype([tuple(field) for field in json.loads(descr)])
+
+
+def write_header(store, dtype):
+    """Writes the fixed size header describing the record dtype"""
+    header = (HEADER_TAG + '\n' + json.dumps(dtype.descr)).encode('ascii')
+    if len(header) >= HEADER_SIZE:
+        raise ValueError('history header is too long for ' + str(HEADER_SIZE) + ' bytes')
+    store.write(header.ljust(HEADER_SIZE - 1) + b'\n')
+
+
+def read_history(history_file, mmap=True):
+    """returns the history as a HISTORY_DTYPE structured array, memory mapped read only if mmap is true
+
+    A file written with an older set of columns is converted, the new columns are left empty"""
+    dtype = read_header(history_file)
+    if dtype is None:
+        return np.zeros(0, dtype=HISTORY_DTYPE)
+    rows = (os.path.getsize(history_file) - HEADER_SIZE) // dtype.itemsize
+    if rows <= 0:
+        return np.zeros(0, dtype=HISTORY_DTYPE)
+    if mmap:
+        history = np.memmap(history_file, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(rows,))
+    else:
+        history = np.fromfile(history_file, dtype=dtype, count=rows, offset=HEADER_SIZE)
+    if dtype != HISTORY_DTYPE:
+        history = convert_records(history)
+    return history
+
+
+def convert_records(records):
+    """returns the records converted to HISTORY_DTYPE, fields missing from the records are left empty"""
+    converted = np.zeros(len(records), dtype=HISTORY_DTYPE)
+    for name in HISTORY_DTYPE.names:
+        if name in records.dtype.names:
+            converted[name] = records[name]
+        elif name in STATISTICS_FIELDS:
+            converted[name] = missing_statistic(name)
+    return converted
+
+
+def remove_stale_lock(lock_file):
+    """returns True if the lock file was older than STALE_LOCK_AGE, left by a crashed run, and was removed
+
+    The lock is first renamed to a name of this run's own and only removed if it is still the same file that
+    was found stale, so a new lock created by another run in the meantime is never deleted"""
+    stale = os.stat(lock_file)
+    if time.time() - stale.st_mtime <= STALE_LOCK_AGE:
+        return False
+    moved_file = os.path.splitext(lock_file)[0] + '.{}.stale.lock'.format(os.getpid())
+    os.rename(lock_file, moved_file)
+    moved = os.stat(moved_file)
+    if (moved.st_ino, moved.st_mtime_ns) != (stale.st_ino, stale.st_mtime_ns):
+        os.rename(moved_file, lock_file)  # another run took the lock in between, give it back
+        return False
+    os.remove(moved_file)
+    return True
+
+
+@contextlib.contextmanager
+def history_lock(history_file):
+    """Holds a lock file next to the history file, waits up to LOCK_TIMEOUT seconds for another run"""
+    lock_file = history_file + '.lock'
+    start = time.time()
+    while True:
+        try:
+            lock = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if remove_stale_lock(lock_file):
+                    continue
+            except OSError:
+                continue  # the other run released the lock in the meantime
+            if time.time() - start > LOCK_TIMEOUT:
+                raise TimeoutError('history file ' + history_file + ' is locked by another run, remove ' +
+                                   lock_file + ' if no other analysis is running')
+            time.sleep(0.1)
+    try:
+        os.write(lock, '{} {}'.format(os.getpid(), np.datetime64('now')).encode('ascii'))
+        os.close(lock)
+        yield
+    finally:
+        os.remove(lock_file)
+
+
+def append_history(history_file, records):
+    """Appends the records to the history file, creating it if needed
+
+    A store written with an older set of columns is rewritten once in the current HISTORY_DTYPE first, and a
+    record only partly written by a run that was stopped is removed so the new records stay aligned"""
+    records = np.asarray(records, dtype=HISTORY_DTYPE) if len(records) else np.zeros(0, dtype=HISTORY_DTYPE)
+    with history_lock(history_file):
+        dtype = read_header(history_file)
+        if dtype is not None and dtype != HISTORY_DTYPE:
+            upgraded = read_history(history_file, mmap=False)
+            with open(history_file + '.tmp', 'wb') as store:
+                write_header(store, HISTORY_DTYPE)
+                upgraded.tofile(store)
+            os.replace(history_file + '.tmp', history_file)
+            dtype = HISTORY_DTYPE
+        if dtype is not None:
+            size = os.path.getsize(history_file)
+            partial = (size - HEADER_SIZE) % dtype.itemsize
+            if partial:
+                os.truncate(history_file, size - partial)
+        with open(history_file, 'ab') as store:
+            if dtype is None:
+                write_header(store, HISTORY_DTYPE)
+            store.write(records.tobytes())
+
+
+def parse_legacy_line(line):
+    """returns a HISTORY_DTYPE record tuple from a formatted line of an old history.npy file"""
+    parts = line.split()
+    if len(parts) < 12:
+        raise ValueError('history line has too few columns: ' + line)
+    data = (line[23:63].strip(), parts[-10]) + tuple(float(v) for v in parts[-9:])
+    return history_record(data, '', DEFAULT_TOLERANCE, np.datetime64(parts[0], 's'))
+
+
+def migrate_npy_history(npy_file, history_file):
+    """Appends the rows of an old history.npy array of formatted strings to the history store
+
+    The heading line is skipped, rows are scored against DEFAULT_TOLERANCE and have no device serial"""
+    records = []
+    for line in np.load(npy_file).tolist():
+        if line.startswith('Analysis Date'):
+            continue
+        try:
+            records.append(parse_legacy_line(line))
+        except ValueError as error:
+            print('Skipped history line, ' + str(error))
+    append_history(history_file, records)
+    print(str(len(records)) + ' history rows migrated from ' + npy_file + ' to ' + history_file)
+    return len(records)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print('Invalid input arguments, example usage: python history_store.py history.npy history.dat')
+        exit(1)
+    migrate_npy_history(sys.argv[1], sys.argv[2])
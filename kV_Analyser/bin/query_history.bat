@@ -0,0 +1,2 @@
+python query_history.py history.dat %*
+pause
\ No newline at end of file
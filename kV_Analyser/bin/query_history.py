@@ -0,0 +1,182 @@
+"""Queries the kV dose history store written by analyse_kV_dose.py
+
+Usage:
+          python query_history.py history.dat [options]
+Options:
+          --from DATE, --to DATE  analysis date range, inclusive, e.g. 2023-03 or 2023-03-01
+          --source SOURCE         Orthogonal, Obl_Left, Obl_Right, Left_only, Right_only or Unknown
+          --serial SERIAL         device serial number (0018,1000)
+          --status STATUS         Pass, Fail or Unknown
+          --page N, --page-size N page of results to print, 50 results per page by default
+          --format FORMAT         table, csv or json
+
+An index of the analysis dates, sources, serials and statuses is kept next to the history file in
+history.dat.idx.npz and extended with the rows added since the last query, so a query only reads the
+matching rows instead of the whole history.  The index also holds a checksum of the last row indexed and is
+rebuilt if that row has changed, e.g. after the history was truncated and appended to again.
+
+18.10.26 first version, replaces print_numpy_Array.py for viewing the history"""
+
+import sys, os, argparse, csv, json, hashlib
+import numpy as np
+import history_store
+
+
+INDEXED_COLUMNS = ('source', 'serial', 'status')
+
+
+def index_file_name(history_file):
+    """returns the file name of the index for a history file"""
+    return history_file + '.idx.npz'
+
+
+def row_checksum(history, rows):
+    """returns a checksum of the last of the first rows of the history, empty if rows is 0"""
+    return hashlib.sha1(np.asarray(history[rows - 1:rows]).tobytes()).hexdigest() if rows else ''
+
+
+def load_index(history_file, history):
+    """returns the index of the history, updated with any rows added since it was saved
+
+    The index holds the row numbers in analysis date order and, for each indexed column, the row numbers
+    grouped by value.  New rows are merged into the saved index and only the new rows are read, the index is
+    rebuilt if the last row it holds no longer matches its checksum"""
+    index = {'rows': 0, 'date_order': np.zeros(0, dtype=np.int64),
+             'dates': np.zeros(0, dtype='datetime64[s]')}
+    for column in INDEXED_COLUMNS:
+        index[column] = {}
+    try:
+        with np.load(index_file_name(history_file)) as saved:
+            rows = int(saved['rows'])
+            if rows <= len(history) and str(saved['checksum']) == row_checksum(history, rows):
+                index['rows'] = rows
+                index['date_order'] = saved['date_order']
+                index['dates'] = saved['dates']
+                for column in INDEXED_COLUMNS:
+                    index[column] = dict(zip(saved[column + '_keys'].tolist(),
+                                             np.split(saved[column + '_rows'], saved[column + '_offsets'][1:-1])))
+    except (OSError, KeyError, ValueError):
+        pass  # no usable index, it is rebuilt from the whole history
+    if index['rows'] < len(history):
+        update_index(index, history)
+        save_index(history_file, index)
+    return index
+
+
+def update_index(index, history):
+    """Merges the rows of the history that are not yet in the index"""
+    new_rows = np.arange(index['rows'], len(history))
+    new = np.asarray(history[index['rows']:])
+    dates = np.concatenate([index['dates'], new['analysis_date']])
+    order = np.concatenate([index['date_order'], new_rows])
+    merged = np.argsort(dates, kind='stable')  # the history is appended in date order so this is a short merge
+    index['dates'] = dates[merged]
+    index['date_order'] = order[merged]
+    for column in INDEXED_COLUMNS:
+        values = new[column]
+        for key in np.unique(values).tolist():
+            rows = new_rows[values == key]
+            index[column][key] = np.concatenate([index[column].get(key, np.zeros(0, dtype=np.int64)), rows])
+    index['rows'] = len(history)
+    index['checksum'] = row_checksum(history, len(history))
+
+
+def save_index(history_file, index):
+    """Saves the index next to the history file"""
+    arrays = {'rows': index['rows'], 'checksum': index['checksum'], 'date_order': index['date_order'],
+              'dates': index['dates']}
+    for column in INDEXED_COLUMNS:
+        keys = sorted(index[column])
+        rows = [index[column][key] for key in keys]
+        arrays[column + '_keys'] = np.array(keys, dtype=str)
+        arrays[column + '_rows'] = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        arrays[column + '_offsets'] = np.cumsum([0] + [len(r) for r in rows])
+    try:
+        with open(index_file_name(history_file) + '.tmp', 'wb') as index_file:
+            np.savez(index_file, **arrays)
+        os.replace(index_file_name(history_file) + '.tmp', index_file_name(history_file))
+    except OSError as error:
+        print('History index could not be saved: ' + str(error), file=sys.stderr)
+
+
+def date_limit(text, end):
+    """returns the datetime64 for a date argument, for the end of a range the start of the next day or month"""
+    date = np.datetime64(text)
+    if end:
+        date = date + 1  # one unit of the precision given, so --to 2023-03 includes the whole of March
+    return date.astype('datetime64[s]')
+
+
+def query(history_file, date_from=None, date_to=None, source=None, serial=None, status=None):
+    """returns the history rows matching all of the filters given, in analysis date order"""
+    history = history_store.read_history(history_file)
+    index = load_index(history_file, history)
+    start = 0 if date_from is None else np.searchsorted(index['dates'], date_limit(date_from, False), 'left')
+    end = len(index['dates']) if date_to is None else np.searchsorted(index['dates'], date_limit(date_to, True),
+                                                                       'left')
+    rows = index['date_order'][start:end]
+    for column, value in zip(INDEXED_COLUMNS, (source, serial, status)):
+        if value is not None:
+            rows = rows[np.isin(rows, index[column].get(value, np.zeros(0, dtype=np.int64)))]
+    return np.asarray(history[rows])
+
+
+def print_table(results):
+    """Prints the results in columns matching the analysis output"""
+    print(f'{"Analysis Date":<20} {"file":<30} {"source":<11} {"serial":<10} {"status":<7} {"Dose diff":>9} '
+          f'{"whole mean":>10} {"left mean":>10} {"right mean":>10}')
+    for r in results:
+        print(f'{str(r["analysis_date"]):<20} {r["file"]:<30} {r["source"]:<11} {r["serial"]:<10} {r["status"]:<7} '
+              f'{r["dose_diff"]:>9.1f} {r["whole_mean"]:>10.1f} {r["left_mean"]:>10.1f} {r["right_mean"]:>10.1f}')
+
+
+def result_dicts(results):
+    """returns the results as a list of dictionaries of python values, the empty NaN statistics as None"""
+    return [{name: python_value(r[name]) for name in results.dtype.names} for r in results]
+
+
+def python_value(value):
+    """returns a history value as a python value for csv and json, None for NaN as json has no NaN"""
+    if isinstance(value, np.datetime64):
+        return str(value)
+    value = value.item()
+    return None if isinstance(value, float) and value != value else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the kV dose history store')
+    parser.add_argument('history_file')
+    parser.add_argument('--from', dest='date_from')
+    parser.add_argument('--to', dest='date_to')
+    parser.add_argument('--source')
+    parser.add_argument('--serial')
+    parser.add_argument('--status')
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--format', choices=('table', 'csv', 'json'), default='table')
+    args = parser.parse_args()
+    if args.page < 1 or args.page_size < 1:
+        parser.error('--page and --page-size must be 1 or more')
+    if not os.path.exists(args.history_file):
+        print('History file ' + args.history_file + ' not found')
+        exit(1)
+    try:
+        results = query(args.history_file, args.date_from, args.date_to, args.source, args.serial, args.status)
+    except ValueError as error:
+        print('Invalid query: ' + str(error))
+        exit(1)
+    pages = max(1, -(-len(results) // args.page_size))
+    page = results[(args.page - 1) * args.page_size:args.page * args.page_size]
+    if args.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=results.dtype.names, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(result_dicts(page))
+    elif args.format == 'json':
+        print(json.dumps(result_dicts(page), indent=1, allow_nan=False))
+    else:
+        print_table(page)
+        print('\n{} results, page {} of {}'.format(len(results), args.page, pages))
+
+
+if __name__ == "__main__":
+    main()
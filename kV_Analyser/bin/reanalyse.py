@@ -0,0 +1,272 @@
+"""Re-analyses the archive of old measurements against a chosen baseline version
+
+Every image found under the archive folder and its sub folders is analysed again with analyse_kV_dose.py and
+scored against the chosen baseline version of its device.  The results are saved in their own history store,
+reanalysis.dat in the output folder, which query_history.py can read, and reanalysis_diff.csv compares each
+result with the result recorded in the history when the image was first analysed.  Progress is checkpointed
+every CHECKPOINT_INTERVAL files, running the same command again after a run was stopped carries on from the
+last checkpoint.
+
+Usage:
+          python reanalyse.py output_dir [options]
+Options:
+          --archive DIR       folder of old measurements, searched recursively, .\\_old_measurements\\ by default
+          --history FILE      history store of the recorded results, .\\bin\\history.dat by default
+          --baselines DIR     baseline directory, .\\bin\\ by default
+          --baseline VERSION  latest (default), a date dd/mm/yyyy for the baselines in use on that date, or the
+                              number of the version listed by baseline_registry.py
+          --device SERIAL     device of the images without a serial number, e.g. opg files, SN68246 by default
+          --extension EXT     .opg (default) or .dcm
+          --jobs N            number of processes, all the cpus by default
+          --restart           discards the results of an earlier run in output_dir and starts again
+
+18.10.26 first version"""
+
+import os, argparse, csv, json, hashlib, datetime
+import numpy as np
+import analyse_kV_dose
+import history_store
+import baseline_registry
+
+
+CHECKPOINT_INTERVAL = 100  # files analysed between checkpoints
+RESULTS_FILE = 'reanalysis.dat'
+CHECKPOINT_FILE = 'reanalysis_checkpoint.jsonl'
+DIFF_FILE = 'reanalysis_diff.csv'
+DIFF_COLUMNS = ('path', 'file', 'source', 'serial', 'baseline_date', 'recorded_date', 'recorded_dose_diff',
+                'recorded_status', 'dose_diff', 'status', 'dose_diff_change')
+
+
+class BaselineChoice:
+    """Picks the chosen version of the baseline of each device from a BaselineRegistry
+
+    Used by analyse_kV_dose.py in place of the registry so every image is scored against that version, version
+    is 'latest', a date dd/mm/yyyy for the baseline in use on that date or an index into the versions"""
+    def __init__(self, registry, version='latest'):
+        self.registry = registry
+        self.version = version
+
+    def constants(self, serial, default=None):
+        """returns the constants of the chosen baseline version of a device, default if it has no such version"""
+        if self.version == 'latest':
+            return self.registry.constants(serial, default=default)
+        if isinstance(self.version, int):
+            versions = self.registry.versions(serial)
+            if -len(versions) <= self.version < len(versions):
+                return versions[self.version]['constants']
+            return default
+        return self.registry.constants_on(serial, self.version, default)
+
+    def fingerprint(self):
+        """returns a hash of every baseline in the registry, so a checkpoint is not resumed after a baseline
+        has changed"""
+        devices = sorted((device, [v['constants'] for v in versions])
+                         for device, versions in self.registry.devices.items())
+        return hashlib.sha1(repr(devices).encode('utf-8')).hexdigest()
+
+
+def parse_version(text):
+    """returns the --baseline argument as 'latest', a version number or a date dd/mm/yyyy"""
+    if text == 'latest':
+        return text
+    try:
+        return int(text)
+    except ValueError:
+        datetime.datetime.strptime(text, '%d/%m/%Y')
+    return text
+
+
+def archive_files(archive, extension):
+    """returns the paths relative to the archive of all image files in it and its sub folders, sorted"""
+    files = []
+    for directory, folders, file_names in os.walk(archive):
+        folders.sort()
+        files += [os.path.relpath(os.path.join(directory, f), archive) for f in file_names
+                  if f.endswith(extension)]
+    return sorted(files)
+
+
+def read_checkpoint(checkpoint_file):
+    """returns the settings and the list of (path, results rows) of the files finished by an earlier run
+
+    results rows is the number of rows in the results store once the file was added, a line only partly
+    written when a run was stopped is ignored.  The settings are None if there is no checkpoint"""
+    settings = None
+    finished = []
+    try:
+        with open(checkpoint_file) as checkpoint:
+            for line in checkpoint:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 'settings' in entry:
+                    settings = entry['settings']
+                else:
+                    finished.append((entry['file'], entry['rows']))
+    except FileNotFoundError:
+        pass
+    return settings, finished
+
+
+def write_checkpoint(checkpoint_file, settings, finished):
+    """Rewrites the checkpoint with the settings and finished files, dropping any partly written line"""
+    with open(checkpoint_file + '.tmp', 'w') as checkpoint:
+        checkpoint.write(json.dumps({'settings': settings}) + '\n')
+        for path, rows in finished:
+            checkpoint.write(json.dumps({'file': path, 'rows': rows}) + '\n')
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def truncate_results(results_file, rows):
+    """Removes the results appended after the last checkpoint by a run that was stopped"""
+    if history_store.read_header(results_file) is None:
+        return
+    size = history_store.HEADER_SIZE + rows * history_store.HISTORY_DTYPE.itemsize
+    if os.path.getsize(results_file) > size:
+        os.truncate(results_file, size)
+
+
+def analyse_archive_file(relative_path, archive, c, baselines):
+    """returns the analysed XrayImages of a file in the archive, or the error message if it could not be read"""
+    directory, file_name = os.path.split(os.path.join(archive, relative_path))
+    return analyse_kV_dose.analyse_frames(file_name, directory + os.sep, c, baselines=baselines)
+
+
+def image_records(xray, file_name):
+    """returns the history records of each xray source found in an analysed XrayImage"""
+    records = []
+    for source, xray_source in ((1, xray.xray_source_1), (2, xray.xray_source_2)):
+        if xray_source != 'None':
+            records.append(history_store.history_record(xray.data_string(file_name, source), xray.serial_number,
+                                                        xray.constants[11], statistics=xray.statistics))
+    return records
+
+
+def reanalyse(output_dir, archive, c, baselines, settings, extension='.opg', jobs=1, restart=False):
+    """Analyses the archive files not finished by an earlier run and appends their results to the results store
+
+    The checkpoint is updated every CHECKPOINT_INTERVAL files, returns the list of (path, results rows) of
+    all the finished files.  Raises ValueError if the earlier run used different settings"""
+    results_file = os.path.join(output_dir, RESULTS_FILE)
+    checkpoint_file = os.path.join(output_dir, CHECKPOINT_FILE)
+    os.makedirs(output_dir, exist_ok=True)
+    if restart:
+        for file_path in (results_file, checkpoint_file):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+    saved_settings, finished = read_checkpoint(checkpoint_file)
+    if saved_settings is not None and saved_settings != settings:
+        raise ValueError(output_dir + ' holds a re-analysis with different settings or baselines, use another '
+                                      'output folder or --restart')
+    rows = finished[-1][1] if finished else 0
+    truncate_results(results_file, rows)
+    write_checkpoint(checkpoint_file, settings, finished)
+    done = {path for path, _ in finished}
+    file_list = [f for f in archive_files(archive, extension) if f not in done]
+    print('{} files to analyse, {} already analysed'.format(len(file_list), len(done)))
+    records = []
+    pending = []
+    with open(checkpoint_file, 'a') as checkpoint:
+        for i, (relative_path, xrays) in enumerate(zip(file_list, analyse_kV_dose.map_files(
+                analyse_archive_file, file_list, jobs, archive=archive, c=c, baselines=baselines)), 1):
+            if isinstance(xrays, str):
+                print('\n' + xrays + '\n')
+                xrays = []
+            for xray in xrays:
+                records += image_records(xray, xray.frame_name(os.path.basename(relative_path)))
+            pending.append((relative_path, rows + len(records)))
+            if len(pending) == CHECKPOINT_INTERVAL or i == len(file_list):
+                history_store.append_history(results_file, records)
+                for path, file_rows in pending:
+                    checkpoint.write(json.dumps({'file': path, 'rows': file_rows}) + '\n')
+                checkpoint.flush()
+                finished += pending
+                rows += len(records)
+                records = []
+                pending = []
+                print('{} of {} files analysed'.format(i, len(file_list)))
+    return finished
+
+
+def write_diff(diff_file, results, finished, history, c, baselines):
+    """Writes the csv comparing each re-analysed result with the latest result recorded in the history for the
+    same image and source, a source found only in the re-analysis or only in the history has the other side
+    empty.  returns the number of results, of results with a different status and of unmatched sources"""
+    recorded = {}
+    for row in np.asarray(history):  # later analyses of an image replace the earlier ones
+        recorded.setdefault(str(row['file']).strip()[:30], {})[str(row['source'])] = row
+    counts = [0, 0, 0]
+    start = 0
+    with open(diff_file, 'w', newline='') as diff:
+        writer = csv.writer(diff, lineterminator='\n')
+        writer.writerow(DIFF_COLUMNS)
+        for path, rows in finished:
+            images = {}
+            for row in results[start:rows]:
+                images.setdefault(str(row['file']), {})[str(row['source'])] = row
+            start = rows
+            for file_name, new in images.items():
+                old = recorded.get(file_name[:30], {})
+                for source in list(new) + [s for s in old if s not in new]:
+                    row = new.get(source)
+                    recorded_row = old.get(source)
+                    serial = str((row if row is not None else recorded_row)['serial'])
+                    line = [path, file_name, source, serial, baselines.constants(serial or None, default=c)[0]]
+                    line += (['', '', ''] if recorded_row is None else
+                             [str(recorded_row['analysis_date']), '{:.2f}'.format(recorded_row['dose_diff']),
+                              recorded_row['status']])
+                    line += ['', ''] if row is None else ['{:.2f}'.format(row['dose_diff']), row['status']]
+                    line.append('' if row is None or recorded_row is None else
+                                '{:.2f}'.format(row['dose_diff'] - recorded_row['dose_diff']))
+                    writer.writerow(line)
+                    if row is not None:
+                        counts[0] += 1
+                        if recorded_row is not None and row['status'] != recorded_row['status']:
+                            counts[1] += 1
+                    if row is None or recorded_row is None:
+                        counts[2] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-analyse the archive of old kV dose measurements')
+    parser.add_argument('output_dir')
+    parser.add_argument('--archive', default='.\\_old_measurements\\')
+    parser.add_argument('--history', default='.\\bin\\history.dat')
+    parser.add_argument('--baselines', default='.\\bin\\')
+    parser.add_argument('--baseline', type=parse_version, default='latest')
+    parser.add_argument('--device', default='SN68246')
+    parser.add_argument('--extension', choices=('.opg', '.dcm'), default='.opg')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--restart', action='store_true')
+    args = parser.parse_args()
+    if not os.path.isdir(args.archive):
+        print('Archive folder ' + args.archive + ' not found')
+        exit(1)
+    baselines = BaselineChoice(baseline_registry.BaselineRegistry(args.baselines), args.baseline)
+    c = baselines.constants(args.device)
+    if c is None:
+        print('No baseline version ' + str(args.baseline) + ' found for device ' + args.device)
+        exit(1)
+    settings = {'archive': os.path.abspath(args.archive), 'baseline': args.baseline, 'device': args.device,
+                'extension': args.extension, 'baselines': baselines.fingerprint()}
+    try:
+        finished = reanalyse(args.output_dir, args.archive, c, baselines, settings, args.extension,
+                             max(1, args.jobs), args.restart)
+    except ValueError as error:
+        print(error)
+        exit(1)
+    except KeyboardInterrupt:
+        print('\nStopped, run the same command again to carry on from the last checkpoint')
+        exit(1)
+    results = history_store.read_history(os.path.join(args.output_dir, RESULTS_FILE))
+    diff_file = os.path.join(args.output_dir, DIFF_FILE)
+    counts = write_diff(diff_file, results, finished, history_store.read_history(args.history), c, baselines)
+    print('{} results saved in {}, {} with a different status to the recorded result and {} sources found only '
+          'in the re-analysis or only in the history, see {}'.format(
+              counts[0], os.path.join(args.output_dir, RESULTS_FILE), counts[1], counts[2], diff_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Region of interest statistics for the Lynx images from summed-area tables
+
+IntegralImage builds the summed-area table of an image once, and of its square when a variance is first
+needed, after which the sum, mean and variance of any rectangular region is four table lookups however
+large the region or however many regions are used.  The regions and summary values of each protocol are set
+in PROTOCOLS: grids and column bands for uniformity and mirrored pairs for symmetry.  analyse_kV_dose.py
+evaluates the protocol chosen with --protocol on each image, prints the results and adds them to a csv file
+next to the history with append_results().
+
+Regions use python slice conventions, [top, bottom) rows and [left, right) columns, negative values count
+from the bottom or right edge of the image.
+
+18.10.26 first version"""
+
+import os, csv, collections
+import numpy as np
+
+
+Roi = collections.namedtuple('Roi', ['name', 'top', 'bottom', 'left', 'right'])
+Protocol = collections.namedtuple('Protocol', ['rois', 'summary'])  # functions of the image shape and of the stats
+ROI_STATS_DTYPE = np.dtype([('name', 'U24'), ('sum', float), ('mean', float), ('variance', float)])
+RESULT_COLUMNS = ('analysis_date', 'file', 'serial', 'protocol', 'roi', 'sum', 'mean', 'variance', 'value')
+
+
+class IntegralImage:
+    """Summed-area tables of an image and of its square, for O(1) region sums, means and variances"""
+    def __init__(self, image):
+        self.shape = image.shape
+        self.image = image
+        self.sum_table = self.table(image)
+        self.square_table = None
+
+    @staticmethod
+    def table(image):
+        """returns the summed-area table of the image, with a row and column of zeros before the first pixel
+
+        Integer images are summed exactly, in uint32 when the sum of the whole image fits, else in int64"""
+        dtype = float
+        if image.dtype.kind in 'ui':
+            fits = image.size and image.min() >= 0 and image.size * int(image.max()) < 2 ** 32
+            dtype = np.uint32 if fits else np.int64
+        table = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=dtype)
+        np.cumsum(image, axis=0, dtype=dtype, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, dtype=dtype, out=table[1:, 1:])
+        return table
+
+    def bounds(self, rois):
+        """returns arrays of the top, bottom, left and right edges of the regions, clipped to the image"""
+        edges = np.array([[*slice(r.top, r.bottom).indices(self.shape[0])[:2],
+                           *slice(r.left, r.right).indices(self.shape[1])[:2]] for r in rois], dtype=int).reshape(-1, 4)
+        edges[:, 1] = np.maximum(edges[:, 1], edges[:, 0])
+        edges[:, 3] = np.maximum(edges[:, 3], edges[:, 2])
+        return edges.T
+
+    @staticmethod
+    def lookup(table, top, bottom, left, right):
+        """returns the sums of the regions from a summed-area table, in int64 from an integer table"""
+        wide = np.int64 if table.dtype.kind in 'ui' else float
+        return table[bottom, right].astype(wide) - table[top, right] - table[bottom, left] + table[top, left]
+
+    def sum(self, top, bottom, left, right):
+        """returns the sum of the pixels in rows top to bottom and columns left to right, like a slice"""
+        return self.sums([Roi('', top, bottom, left, right)])[0]
+
+    def mean(self, top, bottom, left, right):
+        """returns the mean of the pixels in rows top to bottom and columns left to right, like a slice"""
+        top, bottom, left, right = self.bounds([Roi('', top, bottom, left, right)])
+        return (self.lookup(self.sum_table, top, bottom, left, right) / ((bottom - top) * (right - left)))[0]
+
+    def sums(self, rois):
+        """returns an array of the pixel sums of the regions"""
+        return self.lookup(self.sum_table, *self.bounds(rois))
+
+    def statistics(self, rois):
+        """returns a ROI_STATS_DTYPE array of the sum, mean and variance of each region"""
+        if self.square_table is None:
+            self.square_table = self.table(np.square(self.image, dtype=np.int64 if self.image.dtype.kind in 'ui'
+                                                     else float))
+        top, bottom, left, right = self.bounds(rois)
+        pixels = (bottom - top) * (right - left)
+        stats = np.zeros(len(rois), dtype=ROI_STATS_DTYPE)
+        stats['name'] = [r.name for r in rois]
+        stats['sum'] = self.lookup(self.sum_table, top, bottom, left, right)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats['mean'] = stats['sum'] / pixels
+            stats['variance'] = np.maximum(self.lookup(self.square_table, top, bottom, left, right) / pixels -
+                                           np.square(stats['mean']), 0)
+        return stats
+
+
+def grid_rois(shape, grid_rows, grid_columns, name='grid'):
+    """returns the regions dividing the image into a grid of grid_rows by grid_columns cells"""
+    row_edges = np.linspace(0, shape[0], grid_rows + 1).astype(int)
+    column_edges = np.linspace(0, shape[1], grid_columns + 1).astype(int)
+    return [Roi('{}_{}_{}'.format(name, i, j), row_edges[i], row_edges[i + 1], column_edges[j], column_edges[j + 1])
+            for i in range(grid_rows) for j in range(grid_columns)]
+
+
+def band_rois(shape, bands, name='band'):
+    """returns full height column bands, splitting the image width into the number of bands given"""
+    edges = np.linspace(0, shape[1], bands + 1).astype(int)
+    return [Roi('{}_{}'.format(name, j), 0, shape[0], edges[j], edges[j + 1]) for j in range(bands)]
+
+
+def symmetry_pairs(shape, size, offsets=(0, 100, 200)):
+    """returns pairs of size x size regions mirrored about the image centre, left/right and top/bottom
+
+    offsets are the distances in pixels of each pair from the image edges"""
+    rows, columns = shape
+    middle_row = rows // 2 - size // 2
+    middle_column = columns // 2 - size // 2
+    pairs = []
+    for offset in offsets:
+        pairs.append((Roi('left_' + str(offset), middle_row, middle_row + size, offset, offset + size),
+                      Roi('right_' + str(offset), middle_row, middle_row + size, columns - offset - size,
+                          columns - offset)))
+        pairs.append((Roi('top_' + str(offset), offset, offset + size, middle_column, middle_column + size),
+                      Roi('bottom_' + str(offset), rows - offset - size, rows - offset, middle_column,
+                          middle_column + size)))
+    return pairs
+
+
+def symmetry(stats, pairs):
+    """returns a dictionary of the percentage difference of the means of each symmetry pair"""
+    means = dict(zip(stats['name'].tolist(), stats['mean'].tolist()))
+    result = {}
+    for first, second in pairs:
+        total = means[first.name] + means[second.name]
+        result[first.name + '/' + second.name] = (means[first.name] - means[second.name]) / total * 200 if total else 0.0
+    return result
+
+
+def uniformity(stats, names=('grid', 'band')):
+    """returns a dictionary of the uniformity in percent, (max - min) / (max + min) of the region means, of each
+    set of regions named name_..."""
+    result = {}
+    for name in names:
+        means = stats['mean'][np.char.startswith(stats['name'], name + '_')]
+        total = means.max() + means.min() if means.size else 0
+        result[name + '_uniformity'] = float((means.max() - means.min()) / total * 100) if total else 0.0
+    return result
+
+
+PROTOCOLS = {
+    'uniformity': Protocol(lambda shape: grid_rois(shape, 5, 5) + band_rois(shape, 6),
+                           lambda shape, stats: uniformity(stats)),
+    'symmetry': Protocol(lambda shape: [roi for pair in symmetry_pairs(shape, 100) for roi in pair],
+                         lambda shape, stats: symmetry(stats, symmetry_pairs(shape, 100))),
+}
+
+
+def evaluate(protocol, image):
+    """returns the ROI_STATS_DTYPE statistics of the regions of a protocol in PROTOCOLS and its summary values"""
+    stats = IntegralImage(image).statistics(PROTOCOLS[protocol].rois(image.shape))
+    return stats, PROTOCOLS[protocol].summary(image.shape, stats)
+
+
+def results_file_name(history_file):
+    """returns the file name of the csv file of protocol results for a history file"""
+    return history_file + '.roi.csv'
+
+
+def result_rows(analysis_date, file_name, serial, protocol, stats, summary):
+    """returns the RESULT_COLUMNS rows of the results of a protocol for one image, a row for each region and
+    then one for each summary value"""
+    rows = [[analysis_date, file_name, serial or '', protocol, s['name'], '{:.0f}'.format(s['sum']),
+             '{:.3f}'.format(s['mean']), '{:.3f}'.format(s['variance']), ''] for s in stats]
+    rows += [[analysis_date, file_name, serial or '', protocol, key, '', '', '', '{:.3f}'.format(value)]
+             for key, value in summary.items()]
+    return rows
+
+
+def append_results(results_file, rows):
+    """Appends the rows to the csv file of protocol results, writing the RESULT_COLUMNS heading to a new file"""
+    new_file = not os.path.exists(results_file)
+    with open(results_file, 'a', newline='') as results:
+        writer = csv.writer(results, lineterminator='\n')
+        if new_file:
+            writer.writerow(RESULT_COLUMNS)
+        writer.writerows(rows)
@@ -0,0 +1,290 @@
+"""Runs the daily kV dose analysis of the measurements folder as a pipeline of stages, replaces run.bat
+
+Each dicom file goes through the stages in turn:
+          normalise  the rescale and receptor translation tags are removed and the SAD, SSD and SID set, the same
+                     edits as the dcmodify calls of run.bat, in one read and write of the file with pydicom, or
+                     in one dcmodify call without a .bak file if pydicom is not installed
+          convert    dicom2opg.jar writes the opg file of each frame
+          analyse    analyse_kV_dose.py analyses the opg files, or the dicom file directly with -n
+          archive    the dicom and opg files are moved to .\\_old_measurements\\ once the results are saved
+The files are processed concurrently, each moving on as soon as its previous stage has finished, so the run
+takes about as long as the slowest stage of one file rather than the sum of all the stages of all the files.
+The analyse stage runs in a pool of processes so the analysis of several files is not held to one cpu.
+A stage whose output is already up to date is skipped: a dicom file with opg files newer than itself is not
+normalised or converted again and a file that already has the tag edits is not rewritten.  Progress is printed
+as each stage of each file finishes, the results are printed in file order once all the files are analysed.
+
+Usage:
+          python .\\bin\\run_pipeline.py [options], run from the kV_Dose_Analysis folder like run.bat
+Options:
+          -d turn on debugging, outputs the quadrant pixel values, region mean values and image statistics
+          -n analyse the dicom files directly, they are not normalised or converted
+          -k keep the files in the measurements folder instead of archiving them
+          --jobs N processes N files at once, 4 by default
+
+18.10.26 first version"""
+
+import sys, os, time, shutil, subprocess, threading, concurrent.futures
+import analyse_kV_dose
+import history_store
+import dose_trend
+import baseline_registry
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+DCMODIFY = '.\\bin\\dcmodify'
+DICOM2OPG = '.\\bin\\dicom2opg.jar'
+CONVERSION_LOG = '.\\dicom2opg_log.txt'
+# tags removed and set by the dcmodify calls of run.bat, as (keyword, tag) and (keyword, tag, value)
+ERASE_TAGS = (('RescaleIntercept', 0x00281052), ('RescaleSlope', 0x00281053), ('RescaleType', 0x00281054),
+              ('XRayImageReceptorTranslation', 0x3002000D))
+SET_TAGS = (('RadiationMachineSAD', 0x30020022, '1000'), ('RadiationMachineSSD', 0x30020024, '0'),
+            ('RTImageSID', 0x30020026, '1000'))
+
+
+class Progress:
+    """Prints a line with the elapsed time and the number of files analysed as each stage of a file finishes"""
+    def __init__(self, files):
+        self.files = files
+        self.analysed = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def update(self, file_name, message, stage_start=None, analysed=False):
+        """Prints the message for a file, with the time taken by the stage if stage_start is given"""
+        with self.lock:
+            self.analysed += analysed
+            took = '' if stage_start is None else ' in {:.1f} s'.format(time.perf_counter() - stage_start)
+            print('{:7.1f} s  {:>3}/{} analysed  {}: {}{}'.format(time.perf_counter() - self.start, self.analysed,
+                                                                 self.files, file_name, message, took))
+
+
+def tag_string(tag):
+    """returns a tag number in the (gggg,eeee) form used by dcmodify"""
+    return '({:04x},{:04x})'.format(tag >> 16, tag & 0xFFFF)
+
+
+def normalise_tags(file_path):
+    """Applies the tag edits of run.bat to a dicom file in one read and write, returns False if it already had them
+
+    Uses one dcmodify call without a .bak file if pydicom is not installed"""
+    if pydicom is None:
+        command = [DCMODIFY, '-nb', '-ie']
+        for keyword, tag in ERASE_TAGS:
+            command += ['-e', tag_string(tag)]
+        for keyword, tag, value in SET_TAGS:
+            command += ['-i', tag_string(tag) + '=' + value]
+        run_command(command + [file_path], 'dcmodify')
+        return True
+    try:
+        dataset = pydicom.dcmread(file_path)
+    except pydicom.errors.InvalidDicomError as error:
+        raise ValueError(file_path + ' is not a dicom file, ' + str(error))
+    if (all(keyword not in dataset for keyword, tag in ERASE_TAGS) and
+            all(dataset.get(keyword) is not None and float(dataset.get(keyword)) == float(value)
+                for keyword, tag, value in SET_TAGS)):
+        return False
+    for keyword, tag in ERASE_TAGS:
+        if keyword in dataset:
+            delattr(dataset, keyword)
+    for keyword, tag, value in SET_TAGS:
+        setattr(dataset, keyword, value)
+    dataset.save_as(file_path + '.tmp')
+    os.replace(file_path + '.tmp', file_path)
+    return True
+
+
+def run_command(command, name):
+    """Runs a command and returns its output, raises ValueError if it fails"""
+    try:
+        completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except OSError as error:
+        raise ValueError(name + ' could not be run, ' + str(error))
+    if completed.returncode:
+        raise ValueError(name + ' failed on ' + command[-1] + '\n' + completed.stdout)
+    return completed.stdout
+
+
+def converted_files(path, file_name):
+    """returns the opg files dicom2opg has written for a dicom file, named after it with the frame number"""
+    stem = os.path.splitext(file_name)[0] + '_'
+    return sorted(f for f in os.listdir(path) if f.startswith(stem) and f.endswith('.opg') and
+                  f[len(stem):-len('.opg')].isdigit())
+
+
+def opg_up_to_date(path, file_name):
+    """returns True if the dicom file has been converted and its opg files are newer than it"""
+    opg_files = converted_files(path, file_name)
+    modified = os.path.getmtime(path + file_name)
+    return bool(opg_files) and all(os.path.getmtime(path + f) >= modified for f in opg_files)
+
+
+def prepare_file(file_name, path, progress):
+    """Normalises and converts a dicom file unless its opg files are up to date
+
+    returns the names of the opg files to analyse and the output of dicom2opg"""
+    if opg_up_to_date(path, file_name):
+        progress.update(file_name, 'opg files up to date, normalise and convert skipped')
+        return converted_files(path, file_name), ''
+    start = time.perf_counter()
+    progress.update(file_name, 'normalised' if normalise_tags(path + file_name) else 'already normalised', start)
+    start = time.perf_counter()
+    output = run_command(['java', '-jar', DICOM2OPG, path + file_name, '-exit'], 'dicom2opg')
+    opg_files = converted_files(path, file_name)
+    if not opg_files:
+        raise ValueError('dicom2opg did not write an opg file for ' + file_name + '\n' + output)
+    progress.update(file_name, 'converted to ' + ', '.join(opg_files), start)
+    return opg_files, output
+
+
+def analyse_files(analysed_files, path, c, cache_dir, baselines):
+    """returns a list of the name and analysed XrayImages of each file, or the error message of the first file
+    that could not be analysed, runs in the analysis process pool"""
+    results = []
+    for analysed_file in analysed_files:
+        xrays = analyse_kV_dose.analyse_frames(analysed_file, path, c, cache_dir, baselines)
+        if isinstance(xrays, str):
+            return xrays
+        results.append((analysed_file, xrays))
+    return results
+
+
+def process_file(file_name, path, c, baselines, cache_dir, dicom, progress, analysis_pool):
+    """Runs a measurement file through the normalise, convert and analyse stages, analysing it in analysis_pool
+
+    returns a list of the name and analysed XrayImages of each file analysed, the output of dicom2opg and the
+    names of all the files made from the measurement, or the error message if a stage failed"""
+    output = ''
+    files = [file_name]
+    try:
+        if file_name.endswith('.dcm') and not dicom:
+            analysed_files, output = prepare_file(file_name, path, progress)
+            files += analysed_files
+        else:
+            analysed_files = [file_name]
+        start = time.perf_counter()
+        results = analysis_pool.submit(analyse_files, analysed_files, path, c, cache_dir, baselines).result()
+    except (ValueError, OSError) as error:
+        return str(error)
+    except Exception as error:  # any other failure is reported so the results of the other files are kept
+        return '{} could not be processed, {}: {}'.format(file_name, type(error).__name__, error)
+    if isinstance(results, str):
+        return results
+    progress.update(file_name, 'analysed', start, analysed=True)
+    return results, output, files
+
+
+def measurement_files(path, dicom):
+    """returns the measurement files in the path: the dicom files and, unless dicom is true, the opg files that
+    were not converted from one of them"""
+    names = os.listdir(path)
+    file_list = [f for f in names if f.endswith('.dcm')]
+    if not dicom:
+        converted = set()
+        for file_name in file_list:
+            converted.update(converted_files(path, file_name))
+        file_list += [f for f in names if f.endswith('.opg') and f not in converted]
+    return sorted(file_list)
+
+
+def archive_files(path, file_names, archive_dir):
+    """Moves the files to the archive folder, into a sub folder named by the time if the archive already has a
+    file with the same name"""
+    for file_name in file_names:
+        target_dir = archive_dir
+        if os.path.exists(os.path.join(archive_dir, file_name)):
+            target_dir = os.path.join(archive_dir, time.strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(target_dir, exist_ok=True)
+        shutil.move(path + file_name, os.path.join(target_dir, file_name))
+
+
+def run_pipeline(path, c, baselines, history_file, cache_dir=None, debug=False, dicom=False, archive_dir=None,
+                 jobs=4):
+    """Runs every measurement file in the path through the pipeline, jobs files at a time
+
+    The results are printed in file order and appended to the history file and the dose trends, then the files
+    analysed are moved to archive_dir unless it is None.  Files that fail a stage are reported and left in place"""
+    file_list = measurement_files(path, dicom)
+    if not file_list:
+        analyse_kV_dose.create_file_list(path, '.dcm')  # prints where the old measurements are and exits
+    progress = Progress(len(file_list))
+    workers = max(1, min(jobs, len(file_list)))
+    with concurrent.futures.ProcessPoolExecutor(workers) as analysis_pool, \
+            concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(process_file, file_name, path, c, baselines, cache_dir, dicom, progress,
+                               analysis_pool) for file_name in file_list]
+        results = [future.result() for future in futures]
+    conversion_output = [result[1] for result in results if not isinstance(result, str) and result[1]]
+    if conversion_output:
+        with open(CONVERSION_LOG, 'w') as log:
+            log.writelines(conversion_output)
+    data = ('file', 'source', 'BL','BR', 'TL', 'TR', 'CTR','Dose diff','whole mean','left mean','right mean')
+    print('')
+    analyse_kV_dose.print_heading(data, debug)
+    kV_history = []
+    max_diff, max_diff_source = 0, 'None'
+    for result in results:
+        if isinstance(result, str):
+            print('\n' + result + '\n')
+            continue
+        for file_name, xrays in result[0]:
+            for xray in xrays:
+                max_diff, max_diff_source = analyse_kV_dose.report_xray(xray, xray.frame_name(file_name), kV_history,
+                                                                        debug, max_diff, max_diff_source)
+    history_store.append_history(history_file, kV_history)
+    for warning in dose_trend.update_trends(history_file, kV_history, c, baselines):
+        print('\n' + warning)
+    archived = [result[2] for result in results if not isinstance(result, str)]
+    if archive_dir is not None and archived:
+        start = time.perf_counter()
+        for files in archived:
+            archive_files(path, files, archive_dir)
+        progress.update('{} measurements'.format(len(archived)), 'archived in ' + archive_dir, start)
+
+
+def main():
+    """Calls run_pipeline() with the paths used by analyse_kV_dose.main()
+
+    -d as an argument sets debug to true
+    -n as an argument analyses the .dcm files directly without normalising and converting them
+    -k as an argument keeps the measurement files instead of archiving them
+    --jobs N as arguments processes N files at once"""
+    path = '.\\Measurements\\'  # Directory with the dicom files in it
+    archive_dir = '.\\_old_measurements\\'  # Measurements are moved here once analysed
+    baseline_value_file = '.\\bin\\baseline_SN68246.npy'  # used for images without a device serial number
+    baseline_dir = '.\\bin\\'  # Baselines of all devices, chosen by the device serial number of each image
+    history_file = '.\\bin\\history.dat'  # History stored in this file
+    legacy_history_file = '.\\bin\\history.npy'  # History before v3.7, migrated to history_file on the first run
+    cache_dir = '.\\bin\\image_cache\\'  # Decoded images are cached in this directory
+    debug = False
+    dicom = False
+    jobs = 4
+    for i, a in enumerate(sys.argv):
+        if a == '-d':
+            debug = True
+        elif a == '-n':
+            dicom = True
+        elif a == '-k':
+            archive_dir = None
+        elif a == '--jobs':
+            try:
+                jobs = max(1, int(sys.argv[i + 1]))
+            except (IndexError, ValueError):
+                print('--jobs must be followed by the number of files to process at once, e.g. --jobs 4')
+                exit(1)
+    if dicom and pydicom is None:
+        print('pydicom is needed to analyse the dicom files directly, install it with pip install pydicom')
+        exit(1)
+    if not os.path.exists(history_file) and os.path.exists(legacy_history_file):
+        history_store.migrate_npy_history(legacy_history_file, history_file)
+    constants = analyse_kV_dose.read_baselines(baseline_value_file)
+    baselines = baseline_registry.BaselineRegistry(baseline_dir)
+    if dose_trend.needs_rebuild(history_file):
+        dose_trend.rebuild_trends(history_file, constants, baselines)
+    run_pipeline(path, constants, baselines, history_file, cache_dir, debug, dicom, archive_dir, jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 @echo off
 setlocal
 echo.
-echo Add the baseline values to the setBaseline.py script and backup existing baseline.npy file before continuing
+echo Add the baseline values to the setBaseline.py script before continuing, the existing baseline is kept in baseline_versions
 echo.
 :PROMPT
 SET /P AREYOUSURE=Overrite baselines now (Y/N)?
@@ -1,4 +1,5 @@
 #Creates baseline file for the kV dose script
+import os, time
 import numpy
 
 SN = 18066528 #(0018, 1000) Device Serial Number 
@@ -16,12 +17,13 @@ c10 = 600  # End x for right range
 c11 = 10  # Dose tolerance in percent
 
 
-baselineValueFile = r'baseline.npy'
-previousValueFile = r'previous_baseline.npy'
+baselineValueFile = r'baseline_ID' + str(SN) + '.npy' #Found by analyse_kV_dose.py from the device serial number
+versionsDir = r'baseline_versions' #Replaced baselines are kept here as older versions
 try:    
     baselines = numpy.load(baselineValueFile)
-    numpy.save(previousValueFile, baselines)
-except:
+    os.makedirs(versionsDir, exist_ok=True)
+    numpy.save(os.path.join(versionsDir, 'baseline_ID' + str(SN) + '_' + time.strftime('%Y%m%d-%H%M%S') + '.npy'), baselines)
+except FileNotFoundError:
     print('No previous baseline found')
-baselines = numpy.array([c0,c1,c2,c3,c4,c5,c6,c7,c8,c9,c10,SN])
+baselines = numpy.array([c0,c1,c2,c3,c4,c5,c6,c7,c8,c9,c10,c11,SN])
 numpy.save(baselineValueFile, baselines)
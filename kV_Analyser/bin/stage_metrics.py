@@ -0,0 +1,105 @@
+"""Per file and per stage performance metrics for analyse_kV_dose.py -p
+
+Each stage of a run, listing the measurements folder, reading each image, analysing it, appending to the
+history and updating the dose trends, is recorded with its wall time, cpu time, bytes read and the peak
+memory allocated during the stage.  A summary table is printed at the end of the run and the records are
+appended to a json lines file, one line per stage of each file, to build a performance baseline and spot
+regressions or a slow shared drive: a stage with much more wall time than cpu time is waiting on storage.
+
+Usage:
+          python stage_metrics.py metrics.jsonl
+          prints the summary of the last run saved in the metrics file
+
+18.10.26 first version"""
+
+import sys, os, time, json, contextlib, tracemalloc
+
+
+class StageMetrics:
+    """Records the metrics of each stage of an analysis run, does nothing if enabled is false"""
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, file_name=''):
+        """Records the stage run in the with block, yields the record so bytes_read can be set in the block
+
+        Stages are not nested, the memory peak is reset at the start of each stage"""
+        record = {'stage': name, 'file': file_name, 'bytes_read': 0}
+        if not self.enabled:
+            yield record
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            record['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1] - start_memory
+            record['pid'] = os.getpid()
+            self.records.append(record)
+
+    def extend(self, records):
+        """Adds the records made in a worker process"""
+        if self.enabled:
+            self.records.extend(records)
+
+    def print_summary(self):
+        """Prints the count, total, mean and maximum times, cpu use, bytes read and peak memory of each stage"""
+        print_summary(self.records, time.time() - self.start)
+
+    def save(self, metrics_file):
+        """Appends the records to the json lines metrics file, each line tagged with the start time of the run"""
+        run = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start))
+        try:
+            with open(metrics_file, 'a') as metrics:
+                for record in self.records:
+                    metrics.write(json.dumps(dict(run=run, **record)) + '\n')
+        except OSError as error:
+            print('Metrics could not be saved: ' + str(error))
+            return
+        print('Metrics saved in ' + metrics_file)
+
+
+def print_summary(records, run_time=None):
+    """Prints the summary table of a list of stage records"""
+    stages = []
+    for record in records:
+        if record['stage'] not in stages:
+            stages.append(record['stage'])
+    print(f'\n{"stage":<16} {"count":>6} {"total s":>9} {"mean ms":>9} {"max ms":>9} {"cpu %":>6} {"MB read":>9} '
+          f'{"peak MB":>8}')
+    for stage in stages:
+        stage_records = [r for r in records if r['stage'] == stage]
+        wall = [r['wall_s'] for r in stage_records]
+        cpu = sum(r['cpu_s'] for r in stage_records)
+        print(f'{stage:<16} {len(wall):>6} {sum(wall):>9.3f} {sum(wall) / len(wall) * 1000:>9.1f} '
+              f'{max(wall) * 1000:>9.1f} {cpu / sum(wall) * 100 if sum(wall) else 0:>6.0f} '
+              f'{sum(r["bytes_read"] for r in stage_records) / 1e6:>9.1f} '
+              f'{max(r["peak_memory_bytes"] for r in stage_records) / 1e6:>8.1f}')
+    if run_time is not None:
+        print('Run time {:.3f} s'.format(run_time))
+
+
+def read_metrics(metrics_file):
+    """returns the records of the last run saved in the metrics file"""
+    with open(metrics_file) as metrics:
+        records = [json.loads(line) for line in metrics if line.strip()]
+    return [r for r in records if records and r['run'] == records[-1]['run']]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print('Invalid input arguments, example usage: python stage_metrics.py metrics.jsonl')
+        exit(1)
+    last_run = read_metrics(sys.argv[1])
+    if last_run:
+        print('Run started ' + last_run[0]['run'])
+        print_summary(last_run)
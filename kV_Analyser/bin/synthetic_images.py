@@ -0,0 +1,172 @@
+"""Synthetic Lynx images for testing and benchmarking analyse_kV_dose.py
+
+The patterns copy the corner levels of the real measurements so analyse_kV_dose.py finds the same xray
+sources: an orthogonal field covering the whole detector, a single left or right oblique and both obliques
+together.  Images can be any size of at least 200 x 200 pixels, optionally with saturated pixels, and are
+written as opg files in the format exported by myQA or as RT Image dicom files like the Lynx saves.  A stack
+of images is written as a multi-body opg file or a multi-frame dicom file.
+
+Usage:
+          python synthetic_images.py output_dir [count] [rows] [columns]
+          writes count opg images cycling through the patterns, 4 of 600 x 600 pixels by default
+
+18.10.26 first version"""
+
+import sys, os
+import numpy as np
+try:
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+except ImportError:
+    pydicom = None
+
+PIXEL_SPACING = 0.5  # mm, the Lynx pixel size
+SATURATION = 1023  # pixel value of a saturated Lynx pixel
+PEAK_WIDTH = 60  # standard deviation in pixels of the central peak of the patterns
+DEVICE_SERIAL = '18066528'  # device serial number written to the dicom files
+# mean pixel values at the top left, top right, bottom left and bottom right of the opg pixel array and the centre
+PATTERNS = {
+    'orthogonal': (75, 70, 110, 105, 170),
+    'left': (8, 75, 20, 3, 40),
+    'right': (6, 10, 440, 3, 300),
+    'dual': (13, 73, 439, 3, 320),
+}
+
+
+def make_image(pattern, rows=600, columns=600, saturated=0, seed=0):
+    """returns a rows x columns array of integer pixel values for one of the PATTERNS
+
+    The corner levels are interpolated across the image with a central peak of PEAK_WIDTH pixels and Poisson
+    noise added, if saturated is more than 0 that many pixels at the centre are set to SATURATION.  Images
+    much smaller than 600 x 600 can be classed as a different source as the peak reaches the corners"""
+    if rows < 200 or columns < 200:
+        raise ValueError('synthetic images must be at least 200 x 200 pixels for the 100 pixel corner regions')
+    top_left, top_right, bottom_left, bottom_right, centre = PATTERNS[pattern]
+    y = np.linspace(0, 1, rows)[:, None]
+    x = np.linspace(0, 1, columns)[None, :]
+    field = (top_left * (1 - y) * (1 - x) + top_right * (1 - y) * x + bottom_left * y * (1 - x) +
+             bottom_right * y * x)
+    distance = ((x - 0.5) * columns) ** 2 + ((y - 0.5) * rows) ** 2
+    field = field + centre * np.exp(-distance / (2 * PEAK_WIDTH ** 2))
+    pixels = np.random.default_rng(seed).poisson(field).clip(0, SATURATION - 1)
+    if saturated:
+        pixels.reshape(-1)[rows // 2 * columns + columns // 2 - saturated // 2:][:saturated] = SATURATION
+    return pixels
+
+
+def axis(size):
+    """returns the positions in mm of size pixels centred on 0"""
+    return (np.arange(size) - (size - 1) / 2) * PIXEL_SPACING
+
+
+def write_opg(file_path, pixels, name=None):
+    """Writes the pixel array as an opg file with the header and body layout of the myQA export
+
+    A (frames, rows, columns) array is written as one body per frame with plane positions 0, 1, 2 ... mm"""
+    frames = pixels if pixels.ndim == 3 else pixels[None]
+    rows, columns = frames.shape[1:]
+    if name is None:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+    header = ['<opimrtascii>', '', '<asciiheader>', 'File Version:       3', 'Separator:          ","',
+              'Workspace Name:     ', 'File Name:          ', 'Image Name:         ' + name,
+              'Radiation Type:     ', 'Energy:             0.0 MeV', 'SSD:                1000.0 mm',
+              'SID:                1000.0 mm', 'Field Size Cr:      100.0 mm', 'Field Size In:      100.0 mm',
+              'Data Type:          Rel. Dose', 'Data Factor:        1.000', 'Data Unit:          1/10 %',
+              'Length Unit:        mm', 'Plane:              XY', 'No. of Columns:     ' + str(columns),
+              'No. of Rows:        ' + str(rows), 'Number of Bodies:   ' + str(len(frames)), 'Operators Note:     ',
+              '</asciiheader>', '', '']
+    with open(file_path, 'w', newline='\r\n') as opg_file:
+        opg_file.write('\n'.join(header) + '\n')
+        for i, frame in enumerate(frames):
+            lines = ['<asciibody>', 'Plane Position:     {:.1f} mm'.format(i), '',
+                     'X[mm] ,' + ','.join('{:g}'.format(x) for x in axis(columns)) + ',', 'Y[mm]']
+            lines += ['{:g},'.format(y) + ','.join(map(str, row.tolist())) + ',' for y, row in zip(axis(rows), frame)]
+            lines += ['</asciibody>', '', '']
+            opg_file.write('\n'.join(lines) + '\n')
+        opg_file.write('</opimrtascii>\n')
+
+
+def write_dcm(file_path, pixels, serial_number=DEVICE_SERIAL):
+    """Writes the pixel array as an RT Image dicom file with the tags read by analyse_kV_dose.py
+
+    The rows are flipped as in the Lynx dicom files, a (frames, rows, columns) array is written as a multi-frame
+    file, requires pydicom"""
+    if pydicom is None:
+        raise ValueError('pydicom is required to write dicom file ' + file_path)
+    rows, columns = pixels.shape[-2:]
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.1'  # RT Image Storage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = Dataset()
+    dataset.file_meta = file_meta
+    dataset.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.Modality = 'RTIMAGE'
+    dataset.Manufacturer = 'FIMEL'
+    dataset.DeviceSerialNumber = serial_number
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME1'
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.PixelSpacing = [PIXEL_SPACING, PIXEL_SPACING]
+    dataset.ImagePlanePixelSpacing = [PIXEL_SPACING, PIXEL_SPACING]
+    dataset.RTImagePosition = [float(axis(columns)[0]), float(axis(rows)[0])]
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 0
+    if pixels.ndim == 3:
+        dataset.NumberOfFrames = len(pixels)
+    dataset.PixelData = np.ascontiguousarray(pixels[..., ::-1, :], dtype='<u2').tobytes()
+    try:
+        dataset.save_as(file_path, enforce_file_format=True)
+    except TypeError:  # pydicom before 3.0
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+        dataset.save_as(file_path, write_like_original=False)
+
+
+def write_image(file_path, pixels):
+    """Writes the pixel array as a dicom file if the file name ends .dcm, otherwise as an opg file"""
+    if file_path.lower().endswith('.dcm'):
+        write_dcm(file_path, pixels)
+    else:
+        write_opg(file_path, pixels)
+
+
+def write_images(output_dir, count, rows=600, columns=600, extension='.opg', saturated_every=0, unique=None):
+    """Writes count synthetic images cycling through the PATTERNS and returns their file names
+
+    Every saturated_every-th image has saturated pixels.  If unique is given only that many different
+    images are generated and the rest are hard links to them, or copies where links are not supported,
+    so thousands of files can be benchmarked without generating thousands of images"""
+    os.makedirs(output_dir, exist_ok=True)
+    patterns = list(PATTERNS)
+    file_names = []
+    for i in range(count):
+        pattern = patterns[i % len(patterns)]
+        file_name = 'Synthetic_{}_{:05d}_000{}'.format(pattern, i, extension)
+        file_path = os.path.join(output_dir, file_name)
+        if unique is not None and i >= unique:
+            source = os.path.join(output_dir, file_names[i % unique])
+            try:
+                os.link(source, file_path)
+            except OSError:
+                with open(source, 'rb') as original, open(file_path, 'wb') as copy:
+                    copy.write(original.read())
+        else:
+            saturated = 20 if saturated_every and i % saturated_every == saturated_every - 1 else 0
+            write_image(file_path, make_image(pattern, rows, columns, saturated, seed=i))
+        file_names.append(file_name)
+    return file_names
+
+
+if __name__ == "__main__":
+    if not 2 <= len(sys.argv) <= 5:
+        print('Invalid input arguments, example usage: python synthetic_images.py output_dir 4 600 600')
+        exit(1)
+    arguments = [int(a) for a in sys.argv[2:]]
+    names = write_images(sys.argv[1], *arguments)
+    print(str(len(names)) + ' synthetic images written to ' + sys.argv[1])
@@ -0,0 +1,3 @@
+@echo off 
+python .\bin\analyse_kV_dose.py -n
+Pause
\ No newline at end of file
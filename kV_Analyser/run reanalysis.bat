@@ -0,0 +1,3 @@
+@echo off 
+python .\bin\reanalyse.py .\reanalysis\ %*
+Pause
\ No newline at end of file